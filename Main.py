@@ -1,42 +1,108 @@
 import requests # pyright: ignore[reportMissingModuleSource]
 from flask import Flask, render_template_string, request, redirect, jsonify # pyright: ignore[reportMissingModuleImports]
 import pandas as pd # pyright: ignore[reportMissingModuleSource]
+import numpy as np # pyright: ignore[reportMissingImports]
 from datetime import datetime
 import traceback
 import psutil # pyright: ignore[reportMissingModuleSource]
 import os
 import signal
 import sys
-import random
 import string
-import win32print # pyright: ignore[reportMissingModuleSource]
+import secrets
+import hashlib
+import zlib
+try:
+    import win32print # pyright: ignore[reportMissingModuleSource]
+except ImportError:  # not on Windows: use printer_backend "tcp" or "file"
+    win32print = None
+try:
+    import pyarrow as pa # pyright: ignore[reportMissingImports]
+    import pyarrow.feather as feather # pyright: ignore[reportMissingImports]
+except ImportError:  # no stock snapshot: cold starts read the workbook
+    pa = feather = None
+try:
+    import orjson # pyright: ignore[reportMissingImports]
+except ImportError:  # stock JSON is encoded with Flask's json provider instead
+    orjson = None
 import qrcode # pyright: ignore[reportMissingModuleSource]
 from io import BytesIO
 from PIL import Image # pyright: ignore[reportMissingImports]
 import threading
+import time
+import queue
+import atexit
+import json
+import sqlite3
+import mmap
+import socket
+import select
+from collections import deque, defaultdict
+from itertools import islice
+from functools import lru_cache
+from concurrent.futures import Future
 
 app = Flask(__name__)
 
 # === CONFIG ===
 excel_file = r"C:\Users\JacobPleasance\OneDrive - Micromix Plant Health Limited\PRODUCTION\A - Jacob Pleasance Files\.MPH Stock WIP (Made by Jacob)\MPH-Stock-Live.xlsx"
 qr_codes_file = r"C:\Users\JacobPleasance\OneDrive - Micromix Plant Health Limited\PRODUCTION\A - Jacob Pleasance Files\.MPH Stock WIP (Made by Jacob)\QR-Codes.txt"
-printed_qr_codes = set()
-qr_generation_lock = threading.Lock()
+# every Goods In / Goods Out change is appended here before it is acknowledged, and folded into excel_file on save
+journal_file = os.path.join(os.path.dirname(excel_file), "MPH-Stock-Journal.jsonl")
+# where the stock lives: "excel" (excel_file + journal_file) or "sqlite" (sqlite_file, with excel_file regenerated as an export)
+stock_backend = "excel"
+# excel backend: columnar copy of the parsed workbook (Feather, needs pyarrow) so restarts skip the xlsx
+snapshot_file = os.path.splitext(excel_file)[0] + ".snapshot"
+sqlite_file = os.path.join(os.path.dirname(excel_file), "MPH-Stock.db")
+# how labels reach the Godex RT700: "win32" (Windows print queue printer_name), "tcp" (raw EZPL
+# straight to printer_host:printer_port, no spooler) or "file" (appended to label_sink_file, for testing)
+printer_backend = "win32"
+printer_name = "Godex RT700"
+printer_host = "192.168.1.50"
+printer_port = 9100
+label_sink_file = os.path.join(os.path.dirname(excel_file), "MPH-Labels.ezpl")
+# how the QR code is put on the label: "native" (the printer's W QR command) or "graphic" (sent as a bitmap,
+# for printers without the W command)
+label_qr_mode = "native"
+# sorted binary index of every QR ID in qr_codes_file (rebuilt from the text file when missing)
+qr_store_file = os.path.join(os.path.dirname(qr_codes_file), "QR-Codes.bin")
+CHANGE_LOG_SIZE = 5000  # stock changes kept for /stock-changes before clients fall back to a full snapshot
+SEARCH_COLUMNS = ('Article Code', 'PRODUCTS', 'QR ID')  # what /search-stock matches against
+CONSOLIDATION_COLUMNS = ('P/O', 'GRN', 'Article Code', 'Location', 'PRODUCTS')  # Goods In adds to a line matching all of these
+# type of each stock column in memory: 'category' (repeated text), 'text', 'number' (empty = null) or 'datetime'
+STOCK_SCHEMA = {'Article Code': 'category', 'PRODUCTS': 'category', 'P/O': 'text', 'GRN': 'category',
+                'Supplier Batch': 'text', 'PACK TYPE': 'category', 'Location': 'category',
+                'Available Quantity': 'number', 'Date Modified': 'datetime', 'Date Counted': 'datetime',
+                'Allocated Quantity': 'number', 'QR ID': 'text'}
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'  # how stock dates are written and shown
+FACET_COLUMNS = ('Article Code', 'PRODUCTS', 'P/O', 'GRN', 'Supplier Batch', 'PACK TYPE', 'Location', 'Allocated Quantity')  # View Stock filter dropdowns
+FLUSH_INTERVAL_SECONDS = 30  # committed (journaled) stock changes are saved to the workbook at most this long after they happen
+FLUSH_MAX_PENDING = 200  # ... or as soon as this many changes are waiting
+STOCK_WRITE_BATCH = 100  # queued Goods In / Goods Out applied back to back and committed together
+STOCK_WRITE_RETRIES = 3  # times a batch is prepared again when the stock is reloaded under it
+EXPORT_INTERVAL_SECONDS = 300  # sqlite backend: excel_file is regenerated this long after stock changes
+JOURNAL_SHEET = '_journal'  # hidden workbook sheet recording which journal entries the workbook holds
+LINE_ID_COLUMN = 'Line ID'  # workbook column holding each stock line's permanent id (the row id / 'index' of the API)
+SSE_MAX_CLIENTS = 32  # open /stock-events streams; further browsers get 503 and keep polling
+SSE_QUEUE_SIZE = 64  # events buffered per stream before that client is told to resync
+SSE_HEARTBEAT_SECONDS = 15
+SSE_MAX_STREAM_SECONDS = 300  # streams are closed after this and the browser reconnects
+PRINT_QUEUE_SIZE = 100  # label jobs waiting for the printer; Goods In stops queueing labels beyond this
+PRINT_MAX_ATTEMPTS = 5  # a job is marked failed after this many tries
+PRINT_RETRY_SECONDS = 2  # wait before the first retry, doubled after every further failure ...
+PRINT_RETRY_MAX_SECONDS = 60  # ... up to this
+PRINT_JOB_HISTORY = 200  # finished jobs kept for /print-jobs
+PRINT_BATCH_JOBS = 20  # waiting jobs sent to the printer together as one spool document
+PRINTER_TIMEOUT_SECONDS = 10  # tcp backend: connect/send timeout
+QR_BITMAP_CACHE_SIZE = 512  # QR bitmaps kept (by QR ID and size) for reprints
+QR_GRAPHIC_DOTS = 200  # width/height of the QR bitmap on "graphic" labels
+QR_POOL_SIZE = 500  # QR IDs reserved in qr_codes_file ahead of use, per refill
+QR_POOL_LOW_WATER = 100  # refill the pool in the background once it drops below this
+QR_STORE_MERGE_SIZE = 20000  # QR IDs held in memory before they are merged into qr_store_file
+STREAM_CHUNK_ROWS = 500  # rows encoded at a time by ?stream= responses
+JSON_COMPRESS_LEVEL = 6  # gzip/deflate level for ?stream= responses
 
 # === helper startup ===
-def load_existing_qr_codes():
-    if os.path.exists(qr_codes_file):
-        try:
-            with open(qr_codes_file, "r", encoding="utf-8") as f:
-                for line in f:
-                    code = line.strip()
-                    if code:
-                        printed_qr_codes.add(code)
-        except Exception as e:
-            print("Could not load existing QR codes:", e)
-
-load_existing_qr_codes()
-
 def terminate_process_on_port(port):
     try:
         for proc in psutil.process_iter(['pid', 'name']):
@@ -51,47 +117,241 @@ def terminate_process_on_port(port):
     except Exception as e:
         print(f"Error terminating process on port {port}: {e}")
 
-# === QR helpers (unchanged) ===
+# === QR helpers ===
+class QrIdStore:
+    """
+    Set of every QR ID ever issued, for exact uniqueness checks, without holding them all
+    in memory. qr_codes_file (one ID per line, appended as IDs are reserved) stays the
+    record; qr_store_file is a sorted array of the 16-character IDs as fixed-width
+    16-byte records, memory-mapped and binary searched. Its 16-byte header says how much
+    of the text file it covers: only lines after that are read at startup, into the
+    `recent` set, together with IDs added since. Once `recent` reaches QR_STORE_MERGE_SIZE,
+    compact() merges it into a new qr_store_file. Lines longer than 16 characters or not
+    ASCII (typed in by hand) are skipped: a generated ID can never be equal to them.
+    Supports `in` and add() like the set it replaces; not thread-safe (QrIdAllocator
+    serialises access).
+    """
+    MAGIC = b'QRIDS1\0\0'
+
+    def __init__(self, path, text_path):
+        self.path = path
+        self.text_path = text_path
+        self.ids = np.empty(0, dtype='S16')
+        self.mm = None
+        self.covered = 0  # bytes of text_path already in self.ids
+        self.recent = set()
+        try:
+            if not self._open():
+                self.rebuild()
+            else:
+                self._read_text(self.covered)
+        except Exception as e:
+            print("Could not load existing QR codes:", e)
+
+    @staticmethod
+    def _fits(qr_id):
+        return len(qr_id) <= 16 and qr_id.isascii()
+
+    def _open(self):
+        """Map qr_store_file; False when it is missing, damaged or older than a rewritten text file."""
+        self._close()
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, "rb") as f:
+            header = f.read(16)
+            if len(header) < 16 or header[:8] != self.MAGIC or (os.path.getsize(self.path) - 16) % 16:
+                return False
+            covered = int.from_bytes(header[8:], 'little')
+            text_size = os.path.getsize(self.text_path) if os.path.exists(self.text_path) else 0
+            if covered > text_size:
+                return False
+            if os.path.getsize(self.path) > 16:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.ids = np.frombuffer(self.mm, dtype='S16', offset=16)
+        self.covered = covered
+        return True
+
+    def _close(self):
+        self.ids = np.empty(0, dtype='S16')
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def _read_text(self, offset):
+        if not os.path.exists(self.text_path):
+            return
+        with open(self.text_path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                code = line.decode("utf-8", "replace").strip()
+                if code:
+                    self.add(code)
+
+    def __contains__(self, qr_id):
+        if qr_id in self.recent:
+            return True
+        if not self._fits(qr_id) or not len(self.ids):
+            return False
+        key = qr_id.encode('ascii')
+        i = int(np.searchsorted(self.ids, key))
+        return i < len(self.ids) and self.ids[i] == key
+
+    def __len__(self):
+        return len(self.ids) + len(self.recent)
+
+    def add(self, qr_id):
+        if self._fits(qr_id):
+            self.recent.add(qr_id)
+
+    def _write(self, ids, covered):
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.MAGIC + covered.to_bytes(8, 'little'))
+            f.write(ids.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        self._close()  # Windows can't replace a mapped file
+        try:
+            os.replace(tmp, self.path)
+        except Exception:
+            # e.g. locked by OneDrive / antivirus: keep checking against the old file
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            self._open()
+            raise
+
+    def compact(self, force=False):
+        """Merge `recent` into qr_store_file (the text file must hold them all: call between appends)."""
+        if not self.recent or (len(self.recent) < QR_STORE_MERGE_SIZE and not force):
+            return
+        added = np.array(sorted(self.recent), dtype='S16')
+        merged = np.union1d(self.ids, added)
+        covered = os.path.getsize(self.text_path)
+        self._write(merged, covered)
+        self.recent = set()
+        self._open()
+        print(f"Merged {len(added)} QR IDs into {self.path} ({len(merged)} in total)")
+
+    def rebuild(self):
+        """Re-import qr_store_file from the whole text file."""
+        self._close()
+        self.recent = set()
+        self.covered = os.path.getsize(self.text_path) if os.path.exists(self.text_path) else 0
+        self._read_text(0)
+        self._write(np.array(sorted(self.recent), dtype='S16'), self.covered)
+        self.recent = set()
+        self._open()
+        print(f"Imported {len(self)} QR IDs from {self.text_path}")
+
+printed_qr_codes = QrIdStore(qr_store_file, qr_codes_file)
+
+QR_ID_CHARS = np.array(list(string.ascii_uppercase + string.digits))
+
+def random_qr_ids(count):
+    """`count` random 16-character IDs from the OS CSPRNG (A-Z, 0-9, unbiased)."""
+    needed = count * 16
+    picks = np.empty(0, dtype=np.uint8)
+    while len(picks) < needed:
+        raw = np.frombuffer(secrets.token_bytes(needed - len(picks) + 16), dtype=np.uint8)
+        # 252 = 7 * 36: dropping the top bytes keeps every character equally likely
+        picks = np.concatenate([picks, raw[raw < 252] % 36])
+    return QR_ID_CHARS[picks[:needed]].reshape(count, 16).view('<U16').ravel().tolist()
+
+class QrIdAllocator:
+    """
+    Hands out unique QR IDs without the request touching the disk.
+    IDs are reserved in batches: generated, checked against every ID already issued and
+    recorded in qr_codes_file with one fsync'd append, then kept in an in-memory pool.
+    allocate(n) takes n IDs from the pool; a background thread refills it once it drops
+    below QR_POOL_LOW_WATER, and a burst larger than the pool reserves the rest directly.
+    IDs left in the pool at shutdown are simply never used.
+    """
+    def __init__(self, path, issued):
+        self.path = path
+        self.issued = issued  # every ID ever reserved (printed_qr_codes, a QrIdStore)
+        self.pool = deque()
+        self.lock = threading.Lock()  # guards the pool
+        self.reserve_lock = threading.Lock()  # one batch reserved at a time
+        self.refilling = False
+
+    def _reserve(self, count):
+        ids = []
+        with self.reserve_lock:
+            while len(ids) < count:
+                for qr_id in random_qr_ids(count - len(ids)):
+                    if qr_id not in self.issued:
+                        self.issued.add(qr_id)
+                        ids.append(qr_id)
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(''.join(qr_id + "\n" for qr_id in ids))
+                    f.flush()
+                    os.fsync(f.fileno())
+            except Exception as e:
+                print(f"Error writing QR codes to file: {e}")
+                return ids
+            try:
+                self.issued.compact()
+            except Exception as e:
+                print(f"Error merging QR IDs into {self.issued.path} (will retry): {e}")
+        return ids
+
+    def _refill(self):
+        try:
+            ids = self._reserve(QR_POOL_SIZE)
+            with self.lock:
+                self.pool.extend(ids)
+        except Exception as e:
+            print(f"Error refilling QR ID pool: {e}")
+        finally:
+            with self.lock:
+                self.refilling = False
+
+    def _start_refill(self):
+        """Start a background refill if the pool is low (call with self.lock held)."""
+        if len(self.pool) < QR_POOL_LOW_WATER and not self.refilling:
+            self.refilling = True
+            threading.Thread(target=self._refill, name='qr-pool', daemon=True).start()
+
+    def prefill(self):
+        with self.lock:
+            self._start_refill()
+
+    def allocate(self, count=1):
+        """`count` new unique QR IDs."""
+        with self.lock:
+            ids = [self.pool.popleft() for _ in range(min(count, len(self.pool)))]
+            self._start_refill()
+        if len(ids) < count:
+            ids += self._reserve(count - len(ids))
+        return ids
+
+qr_allocator = QrIdAllocator(qr_codes_file, printed_qr_codes)
+qr_allocator.prefill()  # so the first receipts take pooled IDs instead of appending to qr_codes_file
+
 def generate_qr_code_id():
-    characters = string.ascii_uppercase + string.digits
-    with qr_generation_lock:
-        while True:
-            qr_id = ''.join(random.choice(characters) for _ in range(16))
-            if qr_id not in printed_qr_codes:
-                printed_qr_codes.add(qr_id)
-                try:
-                    with open(qr_codes_file, "a", encoding="utf-8") as f:
-                        f.write(qr_id + "\n")
-                except Exception as e:
-                    print(f"Error writing QR code to file: {e}")
-                return qr_id
+    return qr_allocator.allocate(1)[0]
 
-def convert_qr_to_ezpl_bitmap(qr_id):
+@lru_cache(maxsize=QR_BITMAP_CACHE_SIZE)
+def qr_bitmap(qr_id, size):
+    """QR code as a size x size 1-bit bitmap: rows of (size + 7) // 8 bytes, MSB first, 1 = black."""
     qr = qrcode.make(qr_id)
-    qr = qr.resize((50, 50), Image.Resampling.LANCZOS)
-    qr = qr.convert('1')
-    hex_data = []
-    for y in range(50):
-        byte_data = 0
-        bit_position = 7
-        for x in range(50):
-            pixel = 1 if qr.getpixel((x, y)) == 0 else 0
-            byte_data |= (pixel << bit_position)
-            bit_position -= 1
-            if bit_position < 0:
-                hex_data.append(format(byte_data, '02X'))
-                byte_data = 0
-                bit_position = 7
-        if bit_position != 7:
-            hex_data.append(format(byte_data, '02X'))
-    return ''.join(hex_data)
-
-def print_godex_label(article, item, batch, grn, qr_id):
-    ezpl = (
+    qr = qr.resize((size, size), Image.Resampling.LANCZOS)
+    black = np.asarray(qr.convert('1').convert('L')) == 0
+    return np.packbits(black, axis=1).tobytes()
+
+def convert_qr_to_ezpl_bitmap(qr_id, size=50):
+    return qr_bitmap(qr_id, size).hex().upper()
+
+def godex_label_ezpl(article, item, batch, grn, qr_id, copies=1):
+    """EZPL (bytes) for one label; the printer itself prints `copies` of it (^P). See label_qr_mode."""
+    head = (
         "^Q50,3\n"
         "^W75\n"
         "^H10\n"
-        "^P1\n"
+        f"^P{copies}\n"
         "^S3\n"
         "^AD\n"
         "^C1\n"
@@ -103,24 +363,1616 @@ def print_godex_label(article, item, batch, grn, qr_id):
         f"AA,10,70,2,2,0,0,Description: {item}\r\n"
         f"AA,10,120,2,2,0,0,Supplier Batch: {batch}\r\n"
         f"AA,10,170,2,2,0,0,GRN NO: {grn}\r\n"
-        f"W360,160,2,2,M,0,11,{len(qr_id)},0\r\n"
-        f"{qr_id}\r\n"
-        "E\r\n"
-    )
+    ).encode("utf-8")
+    if label_qr_mode == 'graphic':
+        # Q x,y,width in bytes,height in dots + the raw bitmap
+        qr = f"Q360,160,{(QR_GRAPHIC_DOTS + 7) // 8},{QR_GRAPHIC_DOTS}\r\n".encode("ascii") + qr_bitmap(qr_id, QR_GRAPHIC_DOTS) + b"\r\n"
+    else:
+        qr = f"W360,160,2,2,M,0,11,{len(qr_id)},0\r\n{qr_id}\r\n".encode("utf-8")
+    return head + qr + b"E\r\n"
+
+def label_copies(print_quantity):
+    """Number of labels asked for on the Goods In form (blank -> 1, 0 disables printing)."""
     try:
-        hPrinter = win32print.OpenPrinter("Godex RT700")
+        return max(0, int(print_quantity)) if print_quantity.strip() else 1
+    except ValueError:
+        print(f"Invalid print quantity '{print_quantity}', printing 1 label")
+        return 1
+
+# === Printer backends ===
+class LabelSendError(OSError):
+    """A send that failed part way: the first `sent` bytes of the document reached the printer."""
+    def __init__(self, message, sent):
+        super().__init__(message)
+        self.sent = sent
+
+class Win32Printer:
+    """
+    Raw EZPL through a Windows print queue (one spool document per send). A document
+    that fails while being spooled is aborted, so none of it is printed.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def send(self, data):
+        hPrinter = win32print.OpenPrinter(self.name)
         try:
             win32print.StartDocPrinter(hPrinter, 1, ("GodexLabel", None, "RAW"))
-            win32print.StartPagePrinter(hPrinter)
-            win32print.WritePrinter(hPrinter, ezpl.encode("utf-8"))
-            win32print.EndPagePrinter(hPrinter)
-            win32print.EndDocPrinter(hPrinter)
+            try:
+                win32print.StartPagePrinter(hPrinter)
+                win32print.WritePrinter(hPrinter, data)
+                win32print.EndPagePrinter(hPrinter)
+                win32print.EndDocPrinter(hPrinter)
+            except Exception:
+                win32print.AbortPrinter(hPrinter)
+                raise
         finally:
             win32print.ClosePrinter(hPrinter)
-    except Exception as exc:
-        print(f"Printing failed: {exc}")
-        print("\n--- RAW EZPL COMMANDS ---\n")
-        print(ezpl)
+
+class RawTcpPrinter:
+    """
+    Raw EZPL to the printer's own port 9100, bypassing the spooler. The connection is kept
+    open between sends; one the printer has dropped is noticed before use (or on the failed
+    write) and replaced by a fresh connection, as long as nothing was sent on it. Other
+    failures raise LabelSendError with the bytes already sent, so the caller can go on
+    from there instead of resending them.
+    """
+    def __init__(self, host, port, timeout=PRINTER_TIMEOUT_SECONDS):
+        self.name = f"{host}:{port}"
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.sock = None
+
+    def _alive(self):
+        """False when the printer has closed the pooled connection (it reads as EOF)."""
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            # anything the printer sent unasked (status bytes) is discarded
+            return not readable or self.sock.recv(4096) != b''
+        except OSError:
+            return False
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def _close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def _connect(self):
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _sendall(self, data):
+        """sendall() that reports how many bytes went out before a failure (LabelSendError)."""
+        view = memoryview(data)
+        sent = 0
+        try:
+            while sent < len(view):
+                sent += self.sock.send(view[sent:])
+        except OSError as e:
+            self._close()
+            raise LabelSendError(str(e), sent) from e
+
+    def send(self, data):
+        with self.lock:
+            if self.sock is not None and not self._alive():
+                self._close()
+            reused = self.sock is not None
+            if self.sock is None:
+                self._connect()
+            try:
+                self._sendall(data)
+            except LabelSendError as e:
+                if not reused or e.sent:
+                    raise
+                # the pooled connection went stale before anything was sent: reconnect once
+                self._connect()
+                self._sendall(data)
+
+class FileLabelSink:
+    """Appends the EZPL to a file instead of printing (testing / no printer attached)."""
+    def __init__(self, path):
+        self.name = path
+        self.path = path
+        self.lock = threading.Lock()
+
+    def send(self, data):
+        with self.lock:
+            with open(self.path, "ab") as f:
+                f.write(data)
+
+def make_printer():
+    if printer_backend == 'tcp':
+        return RawTcpPrinter(printer_host, printer_port)
+    if printer_backend == 'file':
+        return FileLabelSink(label_sink_file)
+    if win32print is None:
+        print(f"win32print is not available, labels will be written to {label_sink_file}")
+        return FileLabelSink(label_sink_file)
+    return Win32Printer(printer_name)
+
+label_printer = make_printer()
+atexit.register(getattr(label_printer, 'close', lambda: None))
+
+# === Label print queue ===
+class PrintQueue:
+    """
+    Labels are printed by a background worker so Goods In never waits on the printer.
+    submit() queues a job (a list of labels, each with its copy count) and returns it, or
+    None when PRINT_QUEUE_SIZE jobs are already waiting; that job is still listed, as
+    failed, so its labels can be reprinted from /print-jobs. The worker sends everything
+    waiting (up to PRINT_BATCH_JOBS jobs) as one spool document. Progress is kept per
+    label: when a send fails, the labels the printer already received in full count as
+    printed (job 'printed' = copies sent) and are not sent again; jobs with nothing left
+    are done. The rest is retried with a doubling delay (PRINT_RETRY_SECONDS ..
+    PRINT_RETRY_MAX_SECONDS); after PRINT_MAX_ATTEMPTS those jobs are marked failed and
+    their remaining EZPL is written to the console as before.
+    Job status: queued -> printing -> done, or retrying / failed.
+    """
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=PRINT_QUEUE_SIZE)
+        self.lock = threading.Lock()
+        self.jobs = {}  # job id -> job, oldest first
+        self._next_id = 1
+        self.thread = None
+
+    def submit(self, labels):
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self.lock:
+            job = {'id': self._next_id, 'status': 'queued', 'labels': [dict(label) for label in labels],
+                   'copies': sum(label['copies'] for label in labels), 'printed': 0,
+                   'attempts': 0, 'error': None, 'created': now, 'updated': now}
+            try:
+                self.queue.put_nowait(job['id'])
+            except queue.Full:
+                job.update(status='failed', error='print queue full')
+            self._next_id += 1
+            self.jobs[job['id']] = job
+            self._trim()
+            if job['status'] == 'failed':
+                return None
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='label-printer', daemon=True)
+                self.thread.start()
+            return dict(job)
+
+    def _trim(self):
+        finished = [i for i, j in self.jobs.items() if j['status'] in ('done', 'failed')]
+        for job_id in finished[:max(0, len(finished) - PRINT_JOB_HISTORY)]:
+            del self.jobs[job_id]
+
+    def _update(self, jobs, **fields):
+        with self.lock:
+            for job in jobs:
+                job.update(fields, updated=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+
+    def _run(self):
+        while True:
+            job_ids = [self.queue.get()]
+            while len(job_ids) < PRINT_BATCH_JOBS:
+                try:
+                    job_ids.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            with self.lock:
+                jobs = [self.jobs[i] for i in job_ids if i in self.jobs]
+            if jobs:
+                self._print(jobs)
+
+    def _print(self, jobs):
+        # (job, label, EZPL) per label still to send, in document order
+        units = [(job, label, godex_label_ezpl(**label)) for job in jobs for label in job['labels']]
+        delay = PRINT_RETRY_SECONDS
+        attempt = 0
+        while True:
+            attempt += 1
+            waiting = list({id(job): job for job, _, _ in units}.values())
+            self._update(waiting, status='printing', attempts=attempt)
+            error = None
+            try:
+                label_printer.send(b''.join(data for _, _, data in units))
+                sent = len(units)
+            except Exception as exc:
+                error = exc
+                received = getattr(exc, 'sent', 0)
+                sent = 0
+                while sent < len(units) and received >= len(units[sent][2]):
+                    received -= len(units[sent][2])
+                    sent += 1
+            with self.lock:
+                for job, label, _ in units[:sent]:
+                    job['printed'] += label['copies']
+            units = units[sent:]
+            left = {id(job) for job, _, _ in units}
+            self._update([job for job in waiting if id(job) not in left], status='done', error=None)
+            if error is None:
+                return
+            waiting = [job for job in waiting if id(job) in left]
+            ids = ', '.join(str(job['id']) for job in waiting)
+            print(f"Printing failed (job {ids}, attempt {attempt}): {error}")
+            if attempt >= PRINT_MAX_ATTEMPTS:
+                self._update(waiting, status='failed', error=str(error))
+                print("\n--- RAW EZPL COMMANDS ---\n")
+                print(b''.join(data for _, _, data in units).decode("utf-8", "replace"))
+                return
+            self._update(waiting, status='retrying', error=str(error))
+            time.sleep(delay)
+            delay = min(delay * 2, PRINT_RETRY_MAX_SECONDS)
+
+    def status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def recent(self):
+        """All jobs still known, newest first."""
+        with self.lock:
+            return [dict(job) for job in reversed(self.jobs.values())]
+
+print_queue = PrintQueue()
+
+# === Live stock events (SSE) ===
+class StockEventHub:
+    """
+    Fan-out of stock change events to /stock-events subscribers.
+    Each subscriber has a bounded queue; publish() never blocks the committing request.
+    A subscriber that falls SSE_QUEUE_SIZE events behind has its backlog replaced by a
+    single 'resync' event so the browser refetches what it shows instead.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+
+    def subscribe(self):
+        with self.lock:
+            if len(self.subscribers) >= SSE_MAX_CLIENTS:
+                return None
+            q = queue.Queue(maxsize=SSE_QUEUE_SIZE)
+            self.subscribers.add(q)
+            return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.subscribers.discard(q)
+
+    def publish(self, event, data):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait((event, data))
+            except queue.Full:
+                # slow client: drop its backlog and make it refetch
+                with q.mutex:
+                    q.queue.clear()
+                q.put_nowait(('resync', {}))
+
+stock_events = StockEventHub()
+
+def sse_message(event, data):
+    return f"event: {event}\ndata: {app.json.dumps(data)}\n\n"
+
+# === Stock schema ===
+def filter_text(value):
+    """A cell as the column filter dropdowns show and compare it (JS String() of its display_frame() value)."""
+    if value is None or value is pd.NaT or (isinstance(value, float) and value != value):
+        return ''
+    if isinstance(value, datetime):
+        return value.strftime(DATE_FORMAT)
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def text_series(s):
+    """filter_text() of a whole column (worked out once per category for categorical columns)."""
+    return s.map(filter_text).astype(object).fillna('')
+
+def apply_stock_schema(df, kept=None):
+    """
+    df with the STOCK_SCHEMA columns converted to their types: categoricals and text with
+    NaN for empty cells, float quantities (thousands separators allowed) and datetime64
+    dates (see parse_dates). Values that aren't numbers / dates are reported and left empty;
+    `kept` (a dict) collects them as {(row id, column): value as read}, so a save can write
+    them back. Other columns are kept as read, with '' for empty cells. Columns already of
+    their type are not converted again.
+    """
+    columns = {}
+    for column in df.columns:
+        s = df[column]
+        kind = STOCK_SCHEMA.get(column)
+        if kind == 'category' and isinstance(s.dtype, pd.CategoricalDtype):
+            pass
+        elif kind in ('category', 'text'):
+            s = s.map(filter_text, na_action='ignore').astype(object)
+            s = s.mask(s == '')
+            if kind == 'category':
+                s = s.astype('category')
+        elif kind == 'number' and s.dtype.kind != 'f':
+            given = text_series(s).str.replace(',', '', regex=False).str.strip()
+            converted = pd.to_numeric(given, errors='coerce').astype('float64')
+            report_unconverted(column, given, converted, s, kept)
+            s = converted
+        elif kind == 'datetime' and s.dtype.kind != 'M':
+            given = s.mask(text_series(s).str.strip() == '').astype(object)
+            converted = parse_dates(given)
+            report_unconverted(column, given.fillna(''), converted, s, kept)
+            s = converted
+        elif kind is None and s.hasnans:
+            s = s.astype(object).fillna('')
+        columns[column] = s
+    return pd.DataFrame(columns, index=df.index)
+
+def parse_dates(given):
+    """
+    Dates (object Series, NaN for empty) as datetime64: DATE_FORMAT / ISO text and date cells
+    as they are, other text day first, the way it is typed in the UK (03/04/2024 = 3 April).
+    """
+    dates = pd.to_datetime(given, errors='coerce', format='ISO8601')
+    rest = given.notna() & dates.isna()
+    if rest.any():
+        dates[rest] = pd.to_datetime(given[rest], errors='coerce', format='mixed', dayfirst=True)
+    return dates
+
+def report_unconverted(column, given, converted, original, kept=None):
+    lost = given.index[(given != '') & converted.isna()]
+    if len(lost):
+        print(f"Warning: {len(lost)} '{column}' value(s) could not be read and are left empty (rows {lost[:10].tolist()})")
+        if kept is not None:
+            kept.update(((row_id, column), original[row_id]) for row_id in lost)
+
+def display_frame(df):
+    """
+    df as the JSON API shows it: '' for empty cells, dates as DATE_FORMAT text and whole
+    numbers as ints. Only applied to the rows being sent, journaled or printed.
+    """
+    columns = {}
+    for column in df.columns:
+        s = df[column]
+        if s.dtype.kind == 'M':
+            s = s.dt.strftime(DATE_FORMAT).astype(object)
+        elif s.dtype.kind == 'f':
+            values = s.to_numpy()
+            whole = np.isfinite(values) & (values == np.round(values))
+            shown = values.astype(object)
+            shown[whole] = values[whole].astype('int64').tolist()
+            s = pd.Series(shown, index=s.index)
+        else:
+            s = s.astype(object)
+        columns[column] = s.where(s.notna(), '')
+    return pd.DataFrame(columns, index=df.index)
+
+def append_stock_row(df, row_id, row):
+    """df plus one row (mapping column -> value) under row_id, converted to df's column types."""
+    new = apply_stock_schema(pd.DataFrame([row], index=[row_id]))
+    grown = {}
+    for column in df.columns.intersection(new.columns):
+        dtype = df[column].dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            extra = [v for v in new[column].dropna().unique() if v not in dtype.categories]
+            if extra:
+                grown[column] = df[column].cat.add_categories(extra)
+                dtype = grown[column].dtype
+            new[column] = new[column].astype(dtype)
+    if grown:
+        df = df.assign(**grown)
+    return pd.concat([df, new])
+
+# === Stock search index ===
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class StockSearchIndex:
+    """
+    Trigram inverted index over the lowercased SEARCH_COLUMNS of every row.
+    search() gives the same rows as a case-insensitive substring match on any of those
+    columns: queries of 3+ characters intersect the posting sets of their trigrams and
+    verify the few candidates, shorter queries scan the prebuilt lowercase texts.
+    Rows are added/removed one at a time as the stock changes.
+    """
+    def __init__(self):
+        self.texts = {}  # row id -> tuple of lowercased column values
+        self.postings = defaultdict(set)  # trigram -> row ids
+
+    def add(self, row_id, values):
+        texts = tuple(filter_text(v).lower() for v in values)
+        self.texts[row_id] = texts
+        for text in texts:
+            for gram in trigrams(text):
+                self.postings[gram].add(row_id)
+
+    def remove(self, row_id):
+        texts = self.texts.pop(row_id, ())
+        for text in texts:
+            for gram in trigrams(text):
+                ids = self.postings.get(gram)
+                if ids is not None:
+                    ids.discard(row_id)
+                    if not ids:
+                        del self.postings[gram]
+
+    def search(self, query):
+        """Row ids whose columns contain `query` (already lowercased), in row id order."""
+        if len(query) < 3:
+            candidates = self.texts.keys()
+        else:
+            postings = sorted((self.postings.get(gram, ()) for gram in trigrams(query)), key=len)
+            candidates = set(postings[0])
+            for ids in postings[1:]:
+                if not candidates:
+                    break
+                candidates &= ids
+        return sorted(row_id for row_id in candidates
+                      if any(query in text for text in self.texts[row_id]))
+
+class HashIndex:
+    """Exact-match index: key -> row ids. Remembers each row's key so it can be removed."""
+    def __init__(self):
+        self.rows = {}  # key -> set of row ids
+        self.keys = {}  # row id -> key
+
+    def add(self, row_id, key):
+        self.keys[row_id] = key
+        self.rows.setdefault(key, set()).add(row_id)
+
+    def remove(self, row_id):
+        key = self.keys.pop(row_id, None)
+        ids = self.rows.get(key)
+        if ids is not None:
+            ids.discard(row_id)
+            if not ids:
+                del self.rows[key]
+
+    def get(self, key):
+        """Row ids with this key, in row id order."""
+        return sorted(self.rows.get(key, ()))
+
+class FacetCounts:
+    """
+    Distinct values (as filter_text) and row counts of the FACET_COLUMNS, kept up to date
+    row by row as changes are committed. versions[column] is the stock version at which
+    that column's counts last changed, so clients can skip facets they already hold.
+    """
+    def __init__(self, columns, df, version):
+        self.columns = columns
+        texts = [text_series(df[c]) if c in df.columns else pd.Series('', index=df.index) for c in columns]
+        self.texts = dict(zip(df.index, zip(*texts)))  # row id -> texts of its facet columns
+        self.counts = {c: defaultdict(int, t.value_counts().to_dict()) for c, t in zip(columns, texts)}
+        self.versions = dict.fromkeys(columns, version)
+
+    def set(self, row_id, row, version):
+        """Insert or update a row (row: mapping of column -> value, or None to remove it)."""
+        old = self.texts.pop(row_id, None)
+        new = None if row is None else tuple(filter_text(row.get(c, '')) for c in self.columns)
+        if new is not None:
+            self.texts[row_id] = new
+        for i, column in enumerate(self.columns):
+            before = None if old is None else old[i]
+            after = None if new is None else new[i]
+            if before == after:
+                continue
+            counts = self.counts[column]
+            if before is not None:
+                counts[before] -= 1
+                if counts[before] == 0:
+                    del counts[before]
+            if after is not None:
+                counts[after] += 1
+            self.versions[column] = version
+
+# === In-memory stock model ===
+class StaleStockError(RuntimeError):
+    """A commit prepared on a snapshot that is no longer the current stock."""
+
+class StockModel:
+    """
+    Shared in-memory copy of the stock, on top of a storage backend (ExcelStockStore or
+    SqliteStockStore, see stock_backend). The stock is loaded once and only re-read when
+    the store reports a change made outside this process (workbook edited in Excel /
+    synced by OneDrive). Our own write paths hand the new frame to commit(), which makes
+    the changes durable in the store and adopts the frame without reading anything back.
+    Frames handed out by snapshot() are shared between requests: copy before modifying.
+
+    The frame index is a row id that stays stable across our own commits (new rows get
+    fresh ids from allocate_row_id(), ids are never renumbered). Every committed change
+    (insert / update / delete of one row) gets the next `version` number and is kept in a
+    bounded change log so clients can fetch deltas with changes_since(). A reload from
+    disk also bumps the version but starts a new log: clients older than that need a
+    full snapshot. `epoch` is unique per server start; epoch + version identify a snapshot
+    and are what the ETags of the read endpoints are built from.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.lock = threading.RLock()
+        self.commit_lock = threading.Lock()  # one commit at a time; held by the writer while it takes a frame to save
+        self.df = None
+        self.signature = None
+        self.version = 0
+        self.epoch = format(int(time.time()), 'x') + secrets.token_hex(2)  # restarts within a second still differ
+        self._memo = {}
+        self.changes = deque(maxlen=CHANGE_LOG_SIZE)
+        self._log_floor = 0  # oldest version the change log can bring a client forward from
+        self._next_row_id = 0
+        self.search_index = StockSearchIndex()
+        self.qr_index = HashIndex()
+        self.line_index = HashIndex()
+        self.facets = None  # FacetCounts, built on load
+        self.row_versions = {}  # row id -> version of its last change (load version for rows read from the store)
+        self.store_seq = 0  # last change entry the store holds (survives restarts, unlike version)
+        self.kept_cells = {}  # (row id, column) -> value as read, for cells apply_stock_schema couldn't convert
+        store.attach(self)
+
+    def _load(self, signature):
+        df, self.store_seq = self.store.load()
+        # ensure QR ID column exists (in case old file doesn't have it)
+        if 'QR ID' not in df.columns:
+            df['QR ID'] = ''
+        self.kept_cells = {}
+        df = apply_stock_schema(df, self.kept_cells)
+        self.df = df
+        self.signature = signature
+        # never below ids handed out before a reload: the journal may still hold rows under them
+        self._next_row_id = max(self._next_row_id, int(df.index.max()) + 1 if len(df) else 0)
+        self._rebuild_indexes()
+        self.version += 1
+        self.facets = FacetCounts(FACET_COLUMNS, df, self.version)
+        self.row_versions = dict.fromkeys(df.index.tolist(), self.version)
+        self._memo = {}
+        self.changes.clear()
+        self._log_floor = self.version
+        stock_events.publish('resync', {'epoch': self.epoch, 'version': self.version})
+        print(f"Loaded stock from {self.store.name} ({len(df)} rows)")
+
+    def _rebuild_indexes(self):
+        self.search_index = StockSearchIndex()
+        self.qr_index = HashIndex()
+        self.line_index = HashIndex()
+        for row_id, row in self.df.to_dict('index').items():
+            self._index_row(row_id, row)
+
+    def _index_row(self, row_id, row):
+        self.search_index.add(row_id, [row.get(c, '') for c in SEARCH_COLUMNS])
+        qr_id = filter_text(row.get('QR ID', '')).strip()
+        if qr_id:
+            self.qr_index.add(row_id, qr_id)
+        self.line_index.add(row_id, line_key(row.get(c, '') for c in CONSOLIDATION_COLUMNS))
+
+    def _unindex_row(self, row_id):
+        self.search_index.remove(row_id)
+        self.qr_index.remove(row_id)
+        self.line_index.remove(row_id)
+
+    def _stale(self, signature):
+        return self.df is None or (signature != self.signature and not self.store.busy())
+
+    def _read(self, lookup=None):
+        """
+        (version, df[, lookup()]) from one consistent snapshot, re-reading the store only if it
+        changed outside this process. A reload waits for (and is never interleaved with) a commit.
+        """
+        signature = self.store.signature()
+        with self.lock:
+            if not self._stale(signature):
+                return (self.version, self.df) if lookup is None else (self.version, self.df, lookup())
+        with self.commit_lock, self.lock:
+            if self._stale(signature):
+                self._load(signature)
+            return (self.version, self.df) if lookup is None else (self.version, self.df, lookup())
+
+    def state(self):
+        """Return (version, df) for the current snapshot."""
+        return self._read()
+
+    def snapshot(self):
+        return self.state()[1]
+
+    def etag(self, version):
+        return f"{self.epoch}-{version}"
+
+    def row_token(self, row_id):
+        """
+        The 'row_version' clients get for a row: epoch + version of its last change, so a
+        token handed out before a restart (versions start again) never matches afterwards.
+        None for an unknown row.
+        """
+        version = self.row_versions.get(row_id)
+        return None if version is None else self.etag(version)
+
+    def _with_versions(self, find):
+        """(version, df, row ids from find() - all rows for None -, {row id: row version}) from one snapshot."""
+        def lookup():
+            ids = self.df.index.tolist() if find is None else find()
+            return ids, {i: self.row_token(i) for i in ids}
+        version, df, (ids, versions) = self._read(lookup)
+        return version, df, ids, versions
+
+    def search(self, query):
+        """(version, df, row ids matching `query` - all rows for '' -, {row id: row version}) from one snapshot."""
+        return self._with_versions((lambda: self.search_index.search(query)) if query else None)
+
+    def find_qr(self, qr_id):
+        """(version, df, row ids whose QR ID is exactly `qr_id`, {row id: row version})."""
+        return self._with_versions(lambda: self.qr_index.get(qr_id))
+
+    def find_line(self, values):
+        """(version, df, row ids whose CONSOLIDATION_COLUMNS equal `values`)."""
+        return self._read(lambda: self.line_index.get(line_key(values)))
+
+    def facet_counts(self, columns):
+        """(version, df, facet versions of all FACET_COLUMNS, {column: {value: count}} for `columns`) from one snapshot."""
+        version, df, (versions, counts) = self._read(
+            lambda: (dict(self.facets.versions), {c: dict(self.facets.counts[c]) for c in columns}))
+        return version, df, versions, counts
+
+    def memo(self, key, version, build):
+        """Cache build() (derived from snapshot `version`) until the stock changes."""
+        with self.lock:
+            hit = self._memo.get(key)
+            if hit is not None and hit[0] == version:
+                return hit[1]
+        value = build()
+        with self.lock:
+            if version == self.version:
+                self._memo[key] = (version, value)
+        return value
+
+    def allocate_row_id(self):
+        with self.lock:
+            row_id = self._next_row_id
+            self._next_row_id += 1
+            return row_id
+
+    def commit(self, df, changes=(), base_version=None):
+        """
+        Make df the current in-memory stock, after the store has made the changes durable.
+        `changes` lists what the caller did to the frame as (op, row_id) pairs,
+        op being 'insert', 'update' or 'delete'. Called by the StockWriter thread; readers
+        only wait for the final swap, not for the store write.
+        base_version: the version df was derived from; raises StaleStockError (changing
+        nothing) when the stock has moved on since, e.g. reloaded after an edit in Excel.
+        Returns {row id: row_token} of the inserted / updated rows, as of this commit.
+        """
+        with self.commit_lock:
+            if base_version is not None and base_version != self.version:
+                raise StaleStockError(f"stock changed from version {base_version} to {self.version} while the change was prepared")
+            # one display_frame() for the whole batch; the dicts are journaled, indexed and published
+            kept = list(dict.fromkeys(row_id for op, row_id in changes if op != 'delete'))
+            shown = dict(zip(kept, display_frame(df.loc[kept]).reset_index().to_dict('records')))
+            rows = [None if op == 'delete' else shown[row_id] for op, row_id in changes]
+            # rows as they were, so a replay can tell what was edited in Excel since (replay_journal)
+            old = [row_id for op, row_id in changes if op != 'insert']
+            before = display_frame(self.df.loc[old]).to_dict('index') if old else {}
+            entries = []
+            for (op, row_id), row in zip(changes, rows):
+                entry = {'seq': self.store_seq + len(entries) + 1, 'ts': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                         'op': op, 'index': row_id, 'row': row}
+                if op != 'insert':
+                    entry['before'] = before[row_id]
+                entries.append(entry)
+            # durable before anything is acknowledged; raises (and changes nothing) if it can't be written
+            self.store.write(entries)
+            with self.lock:
+                self.store_seq += len(entries)
+                self.df = df
+                since = self.version
+                committed = []
+                for (op, row_id), row in zip(changes, rows):
+                    self.version += 1
+                    self._unindex_row(row_id)
+                    if op != 'delete':
+                        self._index_row(row_id, row)  # display values index the same (filter_text)
+                    self.facets.set(row_id, row, self.version)
+                    if op == 'delete':
+                        self.row_versions.pop(row_id, None)
+                    else:
+                        self.row_versions[row_id] = self.version
+                    committed.append({'seq': self.version, 'op': op, 'index': row_id, 'row': row})
+                tokens = {row_id: self.row_token(row_id) for op, row_id in changes if op != 'delete'}
+                if committed:
+                    self.changes.extend(committed)
+                    self._memo = {}
+                    # rows stay in the change log for /stock-changes; subscribers only need what changed
+                    stock_events.publish('changes', {'epoch': self.epoch, 'since': since, 'version': self.version,
+                                                     'changes': [{'seq': c['seq'], 'op': c['op'], 'index': c['index']}
+                                                                 for c in committed]})
+                return tokens
+
+    def saved(self):
+        """Called by the writer once the frame is on disk: the new file is ours, not an outside edit."""
+        with self.lock:
+            self.signature = self.store.signature()
+
+    def flush(self, force=False):
+        """Save/export the workbook now (force: even if nothing changed since the last save)."""
+        self.store.writer.flush(force)
+
+    def changes_since(self, since):
+        """
+        Changes committed after version `since`, oldest first, or None when the log cannot
+        bring a client at that version up to date (too far behind, or the workbook was reloaded).
+        """
+        with self.lock:
+            if since == self.version:
+                return []
+            first_seq = self.changes[0]['seq'] if self.changes else self.version + 1
+            if since < max(self._log_floor, first_seq - 1) or since > self.version:
+                return None
+            return list(islice(self.changes, since - first_seq + 1, None))
+
+def merge_changes(changes):
+    """Collapse (op, row_id) changes so each row appears once, with the net effect, in order of last change."""
+    net = {}
+    for op, row_id in changes:
+        before = net.pop(row_id, None)
+        if before == 'insert' and op == 'delete':
+            continue  # inserted and removed again: nothing to record
+        net[row_id] = 'insert' if before == 'insert' else op
+    return [(op, row_id) for row_id, op in net.items()]
+
+class StockWriter:
+    """
+    The single writer of the stock. Goods In / Goods Out hand their change to submit() as a
+    mutation: a function taking the current frame and returning (new frame, changes, result),
+    without modifying the frame it was given. A callable result is called with the row_tokens
+    the commit gave the rows that mutation changed (None for rows a later mutation of the
+    batch changed again), before submit() returns, and gives the result instead. One thread applies mutations in arrival order;
+    those queued while it was busy (up to STOCK_WRITE_BATCH) are applied back to back and
+    committed together, so a burst from several terminals costs one journal append /
+    SQLite transaction and no change can overwrite another. Readers keep using the last
+    committed snapshot meanwhile.
+    A mutation that raises fails only its own request; if the commit fails, the whole batch does.
+    If the stock is reloaded while a batch is prepared (an edit made in Excel), the batch is
+    run again on the new stock, up to STOCK_WRITE_RETRIES times.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.queue = queue.Queue()
+        self.start_lock = threading.Lock()
+        self.thread = None
+        self.touched = set()  # rows changed earlier in the batch being applied
+
+    def submit(self, mutation):
+        """Run mutation on the writer thread; returns its result once committed (or raises its error)."""
+        future = Future()
+        with self.start_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='stock-writer', daemon=True)
+                self.thread.start()
+        self.queue.put((mutation, future))
+        return future.result()
+
+    def find_line(self, df, values):
+        """
+        For mutations: row ids of df whose CONSOLIDATION_COLUMNS equal `values`, including lines
+        inserted or changed earlier in the same batch (not in the model's index yet).
+        """
+        key = line_key(values)
+        _, _, ids = self.model.find_line(values)
+        ids = [i for i in ids if i in df.index and i not in self.touched]
+        ids += [i for i in self.touched
+                if i in df.index and line_key(df.loc[i, c] for c in CONSOLIDATION_COLUMNS) == key]
+        return sorted(ids)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < STOCK_WRITE_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._apply(batch)
+
+    def _apply(self, batch):
+        for attempt in range(STOCK_WRITE_RETRIES):
+            try:
+                base_version, df = self.model.state()
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                return
+            changes, done, failed = [], [], []
+            self.touched = set()
+            for mutation, future in batch:
+                try:
+                    new_df, new_changes, result = mutation(df)
+                except Exception as e:
+                    failed.append((future, e))
+                    continue
+                df = new_df
+                changes += new_changes
+                rows = {row_id for _, row_id in new_changes}
+                self.touched.update(rows)
+                done.append((future, result, rows))
+            self.touched = set()
+            try:
+                if done:
+                    tokens = self.model.commit(df, merge_changes(changes), base_version)
+                elif self.model.version != base_version:
+                    raise StaleStockError("stock reloaded while the change was prepared")
+            except StaleStockError as e:
+                print(f"Stock reloaded while applying {len(batch)} request(s), running them again: {e}")
+                continue
+            except Exception as e:
+                print(f"Error committing stock changes ({len(done)} request(s)): {e}")
+                for future, _, _ in done:
+                    future.set_exception(e)
+                for future, error in failed:
+                    future.set_exception(error)
+                return
+            if len(done) > 1:
+                print(f"Committed {len(done)} stock requests together ({len(changes)} change(s))")
+            last = {row_id: k for k, (_, _, rows) in enumerate(done) for row_id in rows}
+            for k, (future, result, rows) in enumerate(done):
+                if callable(result):
+                    result = result({row_id: tokens.get(row_id) if last[row_id] == k else None for row_id in rows})
+                future.set_result(result)
+            for future, error in failed:
+                future.set_exception(error)
+            return
+        error = StaleStockError("stock kept being reloaded; change not applied")
+        for _, future in batch:
+            future.set_exception(error)
+
+# === Workbook persistence ===
+def assign_line_ids(ids, first_new_id=0):
+    """
+    Row ids from a LINE_ID_COLUMN read back from the workbook. Lines without a usable id
+    (added in Excel, or copied so the id is repeated) get new ids after the highest one,
+    and not below first_new_id (ids already given to lines that are only in the journal).
+    """
+    ids = pd.to_numeric(pd.Series(ids), errors='coerce')
+    ids = ids.where((ids >= 0) & (ids == ids.round()))
+    ids = ids.mask(ids.duplicated())
+    missing = ids.isna()
+    if missing.any():
+        start = max(first_new_id, int(ids.max()) + 1 if ids.notna().any() else 0)
+        ids[missing] = range(start, start + int(missing.sum()))
+    return ids.astype('int64').to_numpy()
+
+def read_stock_workbook(path, first_new_id=0):
+    """
+    Read the stock sheet plus the hidden JOURNAL_SHEET written by write_workbook_atomic().
+    Returns (df indexed by row id, last journal seq the workbook holds). Row ids come from
+    the LINE_ID_COLUMN, so they survive sorting and editing the sheet in Excel (see
+    assign_line_ids for first_new_id). Older workbooks without it use the row ids listed
+    in JOURNAL_SHEET, or positional ones.
+    The whole sheet is always read: the StockModel holds every column and saves write them
+    all back, so there is no column subset to read, and read_excel already streams the sheet
+    in openpyxl's read-only mode.
+    """
+    with pd.ExcelFile(path, engine='openpyxl') as xl:
+        df = xl.parse(xl.sheet_names[0])
+        compacted_seq = 0
+        row_ids = None
+        if JOURNAL_SHEET in xl.sheet_names:
+            meta = xl.parse(JOURNAL_SHEET, header=None)
+            compacted_seq = int(meta.iat[0, 1])
+            row_ids = meta.iloc[1:, 0]
+    if LINE_ID_COLUMN in df.columns:
+        df.index = assign_line_ids(df.pop(LINE_ID_COLUMN), first_new_id)
+    elif row_ids is not None and len(row_ids) == len(df):
+        df.index = row_ids.astype(int).to_numpy()
+    return df, compacted_seq
+
+class WorkbookSnapshot:
+    """
+    Columnar side-cache of read_stock_workbook() for one workbook, so cold loads don't
+    parse the xlsx again. Written as uncompressed Feather (read back memory-mapped), so
+    it needs pyarrow; frames Arrow can't hold (columns mixing numbers and text) are not
+    cached. Only Arrow files are read: the snapshot sits in the shared folder next to the
+    workbook, so nothing that can run code (pickle) is ever loaded from it. Keyed by the
+    workbook's mtime/size and content hash: a
+    snapshot is still used when only the mtime moved (e.g. OneDrive touching the file),
+    and ignored once the workbook has been edited in Excel. Only a cache: any problem
+    reading or writing it just means reading the workbook.
+    """
+    ARROW_MAGIC = b'ARROW1'
+    META_KEY = b'mph_snapshot'
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def file_hash(path):
+        h = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def _current(self, meta, workbook_path):
+        st = os.stat(workbook_path)
+        if st.st_size != meta['size']:
+            return False
+        return st.st_mtime_ns == meta['mtime_ns'] or self.file_hash(workbook_path) == meta['hash']
+
+    def load(self, workbook_path):
+        """(df, journal seq) as read_stock_workbook() returned them, or None when there is no current snapshot."""
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, 'rb') as f:
+                if f.read(len(self.ARROW_MAGIC)) != self.ARROW_MAGIC:
+                    return None
+            with pa.memory_map(self.path) as source:
+                reader = pa.ipc.open_file(source)
+                meta = json.loads(reader.schema.metadata[self.META_KEY])
+                if not self._current(meta, workbook_path):
+                    return None
+                df = reader.read_all().to_pandas()
+        except Exception as e:
+            print(f"Ignoring unreadable stock snapshot {self.path}: {e}")
+            return None
+        return df, meta['journal_seq']
+
+    def save(self, workbook_path, df, journal_seq):
+        """Record df as the contents of workbook_path as it is on disk now."""
+        try:
+            st = os.stat(workbook_path)
+            meta = {'mtime_ns': st.st_mtime_ns, 'size': st.st_size,
+                    'hash': self.file_hash(workbook_path), 'journal_seq': int(journal_seq)}
+            tmp_path = self.path + '.tmp'
+            try:
+                table = pa.Table.from_pandas(df)
+            except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+                return  # mixed-type columns: not cached (an older snapshot no longer matches the workbook)
+            table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                                   self.META_KEY: json.dumps(meta).encode()})
+            feather.write_feather(table, tmp_path, compression='uncompressed')
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"Could not write stock snapshot {self.path}: {e}")
+
+def workbook_value(text):
+    """
+    A text/category stock cell as it goes back into the workbook: text that is a number and
+    reads back as the same text (filter_text) is saved as that number, so Article Codes and
+    P/Os typed as numbers in Excel stay numbers. '0123', '1.50' or 16+ digit codes stay text.
+    """
+    if not isinstance(text, str):
+        return text
+    digits = text[1:] if text.startswith('-') else text
+    if digits.isascii() and digits.isdigit():
+        return int(text) if len(digits) <= 15 and (digits == '0' or digits[0] != '0') else text
+    try:
+        number = float(text)
+    except ValueError:
+        return text
+    return number if np.isfinite(number) and not number.is_integer() and repr(number) == text else text
+
+def write_workbook_atomic(path, df, journal_seq=0, kept=None):
+    """
+    Save df next to the workbook, fsync it, then swap it in so readers never see a half-written file.
+    The row ids go in the last column (LINE_ID_COLUMN) and the hidden JOURNAL_SHEET records
+    the journal position, so a restart knows which journal entries still have to be replayed.
+    Numbers held as text by STOCK_SCHEMA are written as number cells again (workbook_value).
+    kept: cells apply_stock_schema couldn't convert ({(row id, column): value as read});
+    they are written back as they were while the cell is still empty in df.
+    """
+    out = df.assign(**{LINE_ID_COLUMN: df.index})
+    for column in df.columns:
+        if STOCK_SCHEMA.get(column) in ('category', 'text') and column != 'QR ID':
+            # categoricals map each category once
+            out[column] = out[column].map(workbook_value, na_action='ignore').astype(object)
+    for (row_id, column), value in (kept or {}).items():
+        if row_id in out.index and column in out.columns and pd.isna(out.at[row_id, column]):
+            if out[column].dtype != object:
+                out[column] = out[column].astype(object)
+            out.at[row_id, column] = value
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        with pd.ExcelWriter(f, engine='openpyxl') as writer:
+            out.to_excel(writer, index=False)
+            ws = writer.book.create_sheet(JOURNAL_SHEET)
+            ws.append(['journal_seq', journal_seq])
+            ws.sheet_state = 'hidden'
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class StockJournal:
+    """
+    Append-only JSON-lines journal of committed stock changes ({"seq", "ts", "op", "index", "row"},
+    plus "before" for updates and deletes), written and fsync'd before a request is acknowledged.
+    Rows are logged with their full new values, so replaying an entry twice is harmless.
+    Compaction: rotate() moves the current journal aside just before the workbook is saved;
+    once the save is on disk compacted() appends that segment to the archive (the audit
+    trail) and removes it. After a crash, records() reads both files.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.rotated_path = path + '.compacting'
+        self.archive_path = os.path.splitext(path)[0] + '-archive.jsonl'
+        self.lock = threading.Lock()
+        self.f = None
+
+    def append(self, entries):
+        if not entries:
+            return
+        data = ''.join(json.dumps(e, default=str) + '\n' for e in entries)
+        with self.lock:
+            if self.f is None:
+                self.f = open(self.path, 'a', encoding='utf-8')
+            self.f.write(data)
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def _close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def rotate(self):
+        with self.lock:
+            self._close()
+            if not os.path.exists(self.path):
+                return
+            if os.path.exists(self.rotated_path):
+                # previous save failed: keep one segment holding everything not yet in the workbook
+                with open(self.path, 'r', encoding='utf-8') as src, open(self.rotated_path, 'a', encoding='utf-8') as dst:
+                    dst.write(src.read())
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self.rotated_path)
+
+    def compacted(self):
+        with self.lock:
+            if not os.path.exists(self.rotated_path):
+                return
+            try:
+                with open(self.rotated_path, 'r', encoding='utf-8') as src, open(self.archive_path, 'a', encoding='utf-8') as dst:
+                    dst.write(src.read())
+            except Exception as e:
+                print(f"Could not archive journal segment: {e}")
+            os.remove(self.rotated_path)
+
+    def records(self, after_seq):
+        """Journal entries with seq > after_seq, oldest first."""
+        entries = []
+        with self.lock:
+            for path in (self.rotated_path, self.path):
+                if not os.path.exists(path):
+                    continue
+                with open(path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            print(f"Skipping unreadable journal line in {path}")  # torn write from a crash
+                            continue
+                        if entry['seq'] > after_seq:
+                            entries.append(entry)
+        return entries
+
+def sheet_edits(df, row_id, before):
+    """Columns of df's row that differ from `before` (the row as last saved): edited in Excel since."""
+    if before is None:
+        return set()
+    shown = display_frame(apply_stock_schema(df.loc[[row_id]])).iloc[0]
+    return {c for c in df.columns if c in before and filter_text(shown[c]) != filter_text(before[c])}
+
+def replay_journal(df, entries, seq):
+    """
+    Apply journal entries to df (indexed by row id). Returns (df, last seq, entries applied).
+    The sheet may have been edited in Excel since it was saved: cells that no longer match an
+    entry's 'before' row are kept (a change to the same cell is reported, not applied), lines
+    deleted there stay deleted, and a line that took the id of a journaled insert is moved to
+    a new id instead of being overwritten.
+    """
+    entries = sorted((e for e in entries if e['seq'] > seq), key=lambda e: e['seq'])
+    if not entries:
+        return df, seq, 0
+    df = df.astype(object)  # logged values may not fit the dtypes read_excel picked
+    next_id = max([int(df.index.max()) + 1 if len(df) else 0] + [e['index'] + 1 for e in entries])
+    edited = {}  # row id -> columns edited in the sheet, None when the line was deleted there
+    for entry in entries:
+        row_id, op = entry['index'], entry['op']
+        if op == 'insert':
+            if row_id in df.index and row_id not in edited:
+                print(f"Workbook line {row_id} has the id of a journaled new line; it is kept as line {next_id}")
+                df = df.rename(index={row_id: next_id})
+                next_id += 1
+            edited[row_id] = set()
+        elif row_id not in edited:
+            before = entry.get('before')  # missing in journals written before it was recorded
+            edited[row_id] = (None if before is not None and row_id not in df.index
+                              else sheet_edits(df, row_id, before) if row_id in df.index else set())
+        cols = edited[row_id]
+        if cols is None:
+            print(f"Journal {op} of line {row_id} skipped: the line was deleted in the workbook")
+        elif op == 'delete':
+            if cols:
+                print(f"Journal delete of line {row_id} skipped: {sorted(cols)} edited in the workbook")
+            else:
+                df = df.drop(index=row_id, errors='ignore')
+                edited[row_id] = None
+        else:
+            row = {k: v for k, v in entry['row'].items() if k != 'index'}
+            before = entry.get('before') or {}
+            clashes = sorted(c for c in cols if c in row and filter_text(row[c]) != filter_text(before.get(c)))
+            if clashes:
+                print(f"Journal {op} of line {row_id} not applied to {clashes}: edited in the workbook")
+            # only what the change changed: other cells keep what the sheet holds (e.g. text that
+            # isn't a number / date, shown and logged as '')
+            row = {k: v for k, v in row.items()
+                   if k not in cols and (not before or filter_text(v) != filter_text(before.get(k)))}
+            if row:
+                for col in row:
+                    if col not in df.columns:
+                        df[col] = ''
+                df.loc[row_id, list(row)] = list(row.values())
+        seq = entry['seq']
+    df = df.fillna('')  # columns of rows inserted by the replay that the entry didn't carry
+    return df, seq, len(entries)
+
+class WorkbookWriter:
+    """
+    Write-behind saving of the stock workbook (journal compaction for the excel backend,
+    the scheduled export for the sqlite one).
+    Commits only count pending changes; a background thread saves the current frame
+    once `max_pending` changes are waiting or the oldest one is `interval` seconds old,
+    so a burst of receipts/picks costs one workbook write. flush() saves now (used at
+    shutdown). A failed save (e.g. workbook open in Excel) is retried later.
+    """
+    def __init__(self, model, store, interval, max_pending=None):
+        self.model = model
+        self.store = store
+        self.interval = interval
+        self.max_pending = max_pending
+        self.cond = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.pending = 0
+        self.first_pending = None
+        self.saving = False
+        self.thread = None
+
+    def busy(self):
+        """True while a save is writing the workbook (the file on disk is ours, half written)."""
+        with self.cond:
+            return self.saving
+
+    def changed(self, count):
+        with self.cond:
+            self._set_pending(self.pending + count)
+
+    def reset(self, count):
+        """The stock was (re)loaded with `count` changes the workbook doesn't hold yet."""
+        with self.cond:
+            self._set_pending(count)
+
+    def _set_pending(self, count):
+        self.pending = count
+        if not count:
+            self.first_pending = None
+            return
+        if self.first_pending is None:
+            self.first_pending = time.monotonic()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='workbook-writer', daemon=True)
+            self.thread.start()
+        self.cond.notify()
+
+    def _due_in(self):
+        """Seconds until the next save is due (0 = now), None when nothing is pending."""
+        if not self.pending:
+            return None
+        if self.max_pending and self.pending >= self.max_pending:
+            return 0
+        return max(0.0, self.first_pending + self.interval - time.monotonic())
+
+    def _run(self):
+        while True:
+            with self.cond:
+                due = self._due_in()
+                while due is None or due > 0:
+                    self.cond.wait(due)
+                    due = self._due_in()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error saving stock workbook (will retry): {e}")
+                time.sleep(self.interval)
+
+    def flush(self, force=False):
+        with self.flush_lock:
+            # no commit may write the store between taking the frame and rotating the journal
+            with self.model.commit_lock, self.model.lock, self.cond:
+                taken = self.pending
+                if (not taken and not force) or self.model.df is None:
+                    return
+                df = self.model.df
+                seq = self.model.store_seq
+                kept = self.model.kept_cells
+                self.store.before_save()
+                self.saving = True
+            try:
+                self.store.save(df, seq, kept)
+                self.model.saved()
+            except Exception:
+                with self.cond:
+                    self.saving = False
+                raise
+            with self.cond:
+                # in the same step as clearing `saving`, so a reload can't reset pending in between
+                self.saving = False
+                self.pending -= taken
+                self.first_pending = time.monotonic() if self.pending else None
+            print(f"Saved stock workbook ({taken} change(s))")
+
+class ExcelStockStore:
+    """
+    The workbook is the database: changes are appended to the StockJournal before they
+    are acknowledged and the workbook is rewritten behind them by a WorkbookWriter.
+    Loading replays journal entries the workbook doesn't hold yet. Outside edits are
+    noticed through the workbook's mtime/size and reloaded right away, even with changes
+    not saved yet: those are in the journal and replayed on top of the edited sheet, without
+    overwriting what was edited there (see replay_journal). With a snapshot_path (and pyarrow installed),
+    the parsed workbook is kept in a WorkbookSnapshot, refreshed on every save.
+    """
+    name = 'workbook'
+
+    def __init__(self, path, journal_path, snapshot_path=None):
+        self.path = path
+        self.journal = StockJournal(journal_path)
+        self.snapshot = WorkbookSnapshot(snapshot_path) if snapshot_path and pa is not None else None
+        self.writer = None
+
+    def attach(self, model):
+        self.writer = WorkbookWriter(model, self, FLUSH_INTERVAL_SECONDS, FLUSH_MAX_PENDING)
+
+    def signature(self):
+        st = os.stat(self.path)  # raises FileNotFoundError like read_excel did
+        return (st.st_mtime_ns, st.st_size)
+
+    def load(self):
+        """(df indexed by row id, last change seq it includes)"""
+        entries = self.journal.records(0)  # everything not compacted yet; replay skips what the workbook holds
+        # lines added in Excel must not take ids of lines that are only in the journal (or in memory)
+        first_new_id = max([e['index'] + 1 for e in entries] +
+                           [self.writer.model._next_row_id if self.writer is not None else 0])
+        cached = self.snapshot.load(self.path) if self.snapshot else None
+        if cached is not None:
+            df, compacted_seq = cached
+        else:
+            df, compacted_seq = read_stock_workbook(self.path, first_new_id)
+            if self.snapshot:
+                kept = {}
+                typed = apply_stock_schema(df, kept)  # typed columns, so Arrow can hold the frame
+                if not kept:  # else the snapshot would lose the cells that didn't convert
+                    df = typed
+                    self.snapshot.save(self.path, df, compacted_seq)
+        df, seq, replayed = replay_journal(df, entries, compacted_seq)
+        if replayed:
+            print(f"Replayed {replayed} journal entries on top of the workbook")
+        if self.writer is not None:
+            self.writer.reset(replayed)  # exactly what the workbook is missing, whatever was pending before
+        return df, seq
+
+    def write(self, entries):
+        self.journal.append(entries)
+        if entries:
+            self.writer.changed(len(entries))
+
+    def busy(self):
+        return self.writer.busy()
+
+    def before_save(self):
+        # later commits go to a fresh journal; this segment is dropped once the workbook is on disk
+        self.journal.rotate()
+
+    def save(self, df, seq, kept=None):
+        write_workbook_atomic(self.path, df, seq, kept)
+        if self.snapshot and not kept:
+            self.snapshot.save(self.path, df, seq)
+        self.journal.compacted()
+
+STOCK_COLUMNS = ('Article Code', 'PRODUCTS', 'P/O', 'GRN', 'Supplier Batch', 'PACK TYPE', 'Location',
+                 'Available Quantity', 'Date Modified', 'Date Counted', 'Allocated Quantity', 'QR ID')
+
+def sql_name(column):
+    return '"' + column.replace('"', '""') + '"'
+
+def sql_value(value):
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    return str(value)  # timestamps etc.
+
+class SqliteStockStore:
+    """
+    Stock kept in a SQLite database (WAL mode); the workbook becomes an export.
+    Each commit is applied to the `stock` table in one transaction before it is
+    acknowledged; excel_file is regenerated from memory EXPORT_INTERVAL_SECONDS after
+    changes, or on demand (/export-stock, --export-xlsx). An empty database imports
+    the workbook (and any journal entries) on first load, see import_workbook().
+    Commits made by another process (e.g. the importer) are noticed through PRAGMA data_version.
+    """
+    name = 'SQLite database'
+
+    def __init__(self, db_path, export_path):
+        self.export_path = export_path
+        self.lock = threading.Lock()
+        self.writer = None
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=FULL')
+        with self.conn:
+            columns = ', '.join(sql_name(c) for c in STOCK_COLUMNS)
+            self.conn.execute(f'CREATE TABLE IF NOT EXISTS stock (row_id INTEGER PRIMARY KEY, {columns})')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS stock_qr_id ON stock ("QR ID")')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS stock_article_code ON stock ("Article Code")')
+            line_columns = ', '.join(sql_name(c) for c in CONSOLIDATION_COLUMNS)
+            self.conn.execute(f'CREATE INDEX IF NOT EXISTS stock_line ON stock ({line_columns})')
+
+    def attach(self, model):
+        self.writer = WorkbookWriter(model, self, EXPORT_INTERVAL_SECONDS)
+
+    def signature(self):
+        with self.lock:
+            return self.conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def _meta(self, key):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _ensure_columns(self, columns):
+        existing = {r[1] for r in self.conn.execute('PRAGMA table_info(stock)')}
+        for column in columns:
+            if column not in existing:
+                self.conn.execute(f'ALTER TABLE stock ADD COLUMN {sql_name(column)}')
+
+    def _upsert(self, row_id, row):
+        self._ensure_columns(row)
+        names = ', '.join(['row_id'] + [sql_name(c) for c in row])
+        marks = ', '.join('?' * (len(row) + 1))
+        self.conn.execute(f'INSERT OR REPLACE INTO stock ({names}) VALUES ({marks})',
+                          [int(row_id)] + [sql_value(v) for v in row.values()])
+
+    def import_workbook(self, path, journal_path):
+        """One-shot import: replace the table with the workbook plus its pending journal entries."""
+        df, seq = ExcelStockStore(path, journal_path).load()
+        kept = {}
+        records = display_frame(apply_stock_schema(df, kept)).to_dict('index')  # same values as later commits write
+        for (row_id, column), value in kept.items():
+            records[row_id][column] = value  # stored as read, like the workbook held it
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM stock')
+            for row_id, row in records.items():
+                self._upsert(row_id, row)
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('change_seq', ?)", (seq,))
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('imported_from', ?)", (path,))
+        print(f"Imported {len(records)} rows from {path} into the stock database")
+
+    def load(self):
+        with self.lock:
+            imported = self._meta('imported_from') is not None
+        if not imported and os.path.exists(self.export_path):
+            self.import_workbook(self.export_path, journal_file)
+        with self.lock:
+            df = pd.read_sql_query('SELECT * FROM stock ORDER BY row_id', self.conn, index_col='row_id')
+            seq = int(self._meta('change_seq') or 0)
+        df.index.name = None
+        return df, seq
+
+    def write(self, entries):
+        if not entries:
+            return
+        with self.lock, self.conn:
+            for entry in entries:
+                if entry['op'] == 'delete':
+                    self.conn.execute('DELETE FROM stock WHERE row_id = ?', (int(entry['index']),))
+                elif 'before' in entry:
+                    # only the changed cells: the others may hold text stored as read (import_workbook)
+                    before = entry['before']
+                    row = {k: v for k, v in entry['row'].items()
+                           if k != 'index' and filter_text(v) != filter_text(before.get(k))}
+                    if row:
+                        self._ensure_columns(row)
+                        sets = ', '.join(f'{sql_name(c)} = ?' for c in row)
+                        self.conn.execute(f'UPDATE stock SET {sets} WHERE row_id = ?',
+                                          [sql_value(v) for v in row.values()] + [int(entry['index'])])
+                else:
+                    self._upsert(entry['index'], {k: v for k, v in entry['row'].items() if k != 'index'})
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('change_seq', ?)", (entries[-1]['seq'],))
+        self.writer.changed(len(entries))
+
+    def busy(self):
+        return False  # the database is never behind memory
+
+    def before_save(self):
+        pass
+
+    def save(self, df, seq, kept=None):
+        write_workbook_atomic(self.export_path, df, seq, kept)
+
+def make_stock_store():
+    if stock_backend == 'sqlite':
+        return SqliteStockStore(sqlite_file, excel_file)
+    return ExcelStockStore(excel_file, journal_file, snapshot_file)
+
+def line_key(values):
+    """Consolidation key, compared as text (filter_text) so 1234 and '1234' match and empty cells are ''."""
+    return tuple(filter_text(v) for v in values)
+
+def stock_record(df, row_id):
+    """One stock row as a JSON-ready dict (display_frame values), with its row id under 'index'."""
+    return display_frame(df.loc[[row_id]]).reset_index().to_dict('records')[0]
+
+stock_model = StockModel(make_stock_store())
+stock_writer = StockWriter(stock_model)
+atexit.register(stock_model.flush)
+
+def not_modified(etag):
+    """304 response if the client already holds `etag` (weak comparison, see stream_json), else None."""
+    if request.if_none_match.contains_weak(etag):
+        resp = app.response_class(status=304)
+        resp.set_etag(etag)
+        resp.headers['Cache-Control'] = 'no-cache'
+        return resp
+    return None
+
+def json_with_etag(body, etag, mimetype='application/json'):
+    resp = app.response_class(body, mimetype=mimetype)
+    resp.set_etag(etag)
+    # let clients keep the payload but always revalidate it
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+def dumps_json(obj):
+    """
+    JSON bytes for stock payloads: orjson when installed, else Flask's provider. Both sort
+    keys and format dates through app.json.default, so they decode to the same values; the
+    bytes differ (orjson is compact UTF-8, Flask separates with ', ' / ': ' and escapes non-ASCII).
+    """
+    if orjson is None:
+        return app.json.dumps(obj).encode('utf-8')
+    return orjson.dumps(obj, default=app.json.default,
+                        option=orjson.OPT_SORT_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_PASSTHROUGH_DATETIME)
+
+def parse_stream_mode(args):
+    """?stream=json (chunked JSON array) or ?stream=ndjson (one row per line); None when absent."""
+    mode = args.get('stream') or None
+    if mode not in (None, 'json', 'ndjson'):
+        raise ValueError("stream must be json or ndjson")
+    return mode
+
+def stream_rows(df, ids=None, versions=None, mode='json'):
+    """
+    Encode the rows of df (ids: only these, in this order) STREAM_CHUNK_ROWS at a time, each
+    as to_dict('records') gives it after display_frame() and reset_index(). versions:
+    add 'row_version' from this dict. Yields the JSON array (mode 'json') or NDJSON in pieces,
+    so neither the records nor the encoded body of the whole stock is ever held at once.
+    """
+    count = len(df) if ids is None else len(ids)
+    if mode == 'json':
+        yield b'['
+    for start in range(0, count, STREAM_CHUNK_ROWS):
+        chunk = df.iloc[start:start + STREAM_CHUNK_ROWS] if ids is None else df.loc[ids[start:start + STREAM_CHUNK_ROWS]]
+        if versions is not None:
+            chunk = chunk.assign(row_version=[versions[i] for i in chunk.index])
+        records = display_frame(chunk).reset_index().to_dict('records')
+        if mode == 'json':
+            yield (b',' if start else b'') + dumps_json(records)[1:-1]
+        else:
+            yield b''.join(dumps_json(record) + b'\n' for record in records)
+    if mode == 'json':
+        yield b']'
+
+def stream_json(chunks, etag, mode):
+    """
+    Chunked response for stream_rows(), gzip/deflate compressed when Accept-Encoding allows.
+    Every chunk is sync-flushed, so the client can start on the rows already sent.
+    The ETag is weak: gzip, deflate and identity bodies of one snapshot share it.
+    """
+    encoding = next((name for name in ('gzip', 'deflate') if request.accept_encodings[name]), None)
+    if encoding is not None:
+        def compressed(chunks=chunks):
+            z = zlib.compressobj(JSON_COMPRESS_LEVEL, zlib.DEFLATED, 31 if encoding == 'gzip' else 15)
+            for chunk in chunks:
+                yield z.compress(chunk) + z.flush(zlib.Z_SYNC_FLUSH)
+            yield z.flush()
+        chunks = compressed()
+    resp = json_with_etag(chunks, etag, 'application/x-ndjson' if mode == 'ndjson' else 'application/json')
+    resp.set_etag(etag, weak=True)
+    resp.headers['Vary'] = 'Accept-Encoding'
+    if encoding is not None:
+        resp.headers['Content-Encoding'] = encoding
+    return resp
+
+# === Stock queries (paging / sorting / column filters) ===
+def column_text(version, df, column):
+    """filter_text() of a whole column of snapshot `version`, cached until the stock changes."""
+    return stock_model.memo(('filter-text', column), version, lambda: text_series(df[column]))
+
+def parse_stock_query(args):
+    """
+    Paging/sorting/filter parameters, or None when none are given (endpoints then keep
+    returning the plain list of rows). Raises ValueError on malformed input.
+      offset, limit  - slice of the result (limit 0 / missing = everything from offset)
+      sort           - comma separated columns, '-' prefix for descending, e.g. 'Location,-Available Quantity'
+      filters        - JSON {"column": ["value", ...]}: OR within a column, AND across columns
+    """
+    if not any(k in args for k in ('offset', 'limit', 'sort', 'filters')):
+        return None
+    offset = int(args.get('offset') or 0)
+    limit = int(args.get('limit') or 0)
+    if offset < 0 or limit < 0:
+        raise ValueError("offset and limit must not be negative")
+    sort = [s.strip() for s in args.get('sort', '').split(',') if s.strip()]
+    return {'offset': offset, 'limit': limit, 'sort': sort, 'filters': parse_filters(args.get('filters'))}
+
+def parse_filters(text):
+    """The `filters` parameter: JSON {"column": ["value", ...]} -> dict without empty lists."""
+    filters = json.loads(text or '{}')
+    if not isinstance(filters, dict) or not all(isinstance(v, list) for v in filters.values()):
+        raise ValueError("filters must be an object of value lists")
+    return {col: [str(v) for v in values] for col, values in filters.items() if values}
+
+def filter_stock(version, full_df, df, filters):
+    """Rows of df (a subset of snapshot `full_df`) matching every column filter."""
+    for column, values in filters.items():
+        if column not in full_df.columns:
+            return df.iloc[0:0]
+        texts = column_text(version, full_df, column)
+        df = df[texts.loc[df.index].isin(values).to_numpy()]
+    return df
+
+def sort_stock(df, sort):
+    """
+    Sort by the given columns; number and date columns by value, text by the numbers in it
+    first and then case-insensitively. Empty cells go last.
+    """
+    keys, ascending = pd.DataFrame(index=df.index), []
+    for i, key in enumerate(sort):
+        column = key.lstrip('-')
+        if column not in df.columns:
+            continue
+        if df[column].dtype.kind in 'iufM':
+            keys[f'value{i}'] = df[column]
+            ascending.append(not key.startswith('-'))
+            continue
+        texts = text_series(df[column])
+        keys[f'num{i}'] = pd.to_numeric(texts, errors='coerce')
+        keys[f'text{i}'] = texts.str.lower().mask(texts == '')  # NaN, so na_position puts empty cells last
+        ascending += [not key.startswith('-')] * 2
+    if not ascending:
+        return df
+    return df.loc[keys.sort_values(list(keys.columns), ascending=ascending, na_position='last').index]
+
+def facet_values(version, df, column, counts, filters):
+    """
+    [[value, count], ...] of `column`, sorted by value. Like Excel's AutoFilter the counts
+    cover the rows passing the filters of the *other* columns; without those they are the
+    incrementally maintained `counts`.
+    """
+    other = {c: v for c, v in filters.items() if c != column}
+    if other:
+        def build():
+            rows = filter_stock(version, df, df, other)
+            return column_text(version, df, column).loc[rows.index].value_counts().to_dict()
+        key = ('facet', column, json.dumps(other, sort_keys=True))
+        counts = stock_model.memo(key, version, build)
+    return sorted(([value, int(n)] for value, n in counts.items()), key=lambda item: item[0])
+
+def query_stock(version, full_df, df, params):
+    """Apply filters, sort and paging; returns the JSON payload {"rows", "total", "offset", "limit", "version"}."""
+    df = filter_stock(version, full_df, df, params['filters'])
+    if params['sort']:
+        df = sort_stock(df, params['sort'])
+    offset, limit = params['offset'], params['limit']
+    page = df.iloc[offset:offset + limit] if limit else df.iloc[offset:]
+    return {"rows": display_frame(page).reset_index().to_dict('records'), "total": len(df),
+            "offset": offset, "limit": limit, "version": version}
 
 # === API endpoints ===
 
@@ -129,14 +1981,29 @@ def get_stock_data():
     """
     Returns the whole stock as JSON.
     NOTE: we return full data (including 'QR ID' internally) but the front-end will hide QR ID columns.
+    Each row carries its row id as 'index' (same as /search-stock and /stock-changes).
+    Answers If-None-Match with 304 while the stock version is unchanged; the encoded body is cached per version.
+    With offset/limit/sort/filters (see parse_stock_query) returns one page instead:
+    {"rows", "total", "offset", "limit", "version"}.
+    Without them, ?stream=json|ndjson sends the rows as they are encoded (see stream_rows).
     """
     try:
-        df = pd.read_excel(excel_file, engine='openpyxl')
-        df = df.fillna('')
-        # ensure QR ID column exists (in case old file doesn't have it)
-        if 'QR ID' not in df.columns:
-            df['QR ID'] = ''
-        return jsonify(df.to_dict('records'))
+        params = parse_stock_query(request.args)
+        stream = parse_stream_mode(request.args)
+    except ValueError as e:
+        return jsonify({"error": f"Bad query: {e}"}), 400
+    try:
+        version, df = stock_model.state()
+        etag = stock_model.etag(version)
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+        if params is not None:
+            return json_with_etag(dumps_json(query_stock(version, df, df, params)), etag)
+        if stream:
+            return stream_json(stream_rows(df, mode=stream), etag, stream)
+        body = stock_model.memo('get-stock-data', version, lambda: dumps_json(display_frame(df).reset_index().to_dict('records')))
+        return json_with_etag(body, etag)
     except FileNotFoundError:
         print("Excel file not found in get_stock_data.")
         return jsonify([]), 404
@@ -144,110 +2011,352 @@ def get_stock_data():
         print(f"Error reading Excel file for JSON endpoint: {e}")
         return jsonify([]), 500
 
+@app.route('/stock-facets', methods=['GET'])
+def stock_facets():
+    """
+    Values and row counts for the View Stock filter dropdowns.
+    ?columns=<comma separated FACET_COLUMNS, default all>&filters=<as /get-stock-data>
+    &epoch=<epoch>&known=<JSON {"column": facet version}> from an earlier response made with the same filters.
+    Returns {"epoch", "version", "facets": {column: {"version", "values": [[value, count], ...]}}},
+    leaving out the columns whose known version is still current.
+    """
+    try:
+        filters = parse_filters(request.args.get('filters'))
+        known = json.loads(request.args.get('known') or '{}')
+        if not isinstance(known, dict):
+            raise ValueError("known must be an object")
+    except ValueError as e:
+        return jsonify({"error": f"Bad query: {e}"}), 400
+    columns = [c.strip() for c in request.args.get('columns', '').split(',') if c.strip()] or list(FACET_COLUMNS)
+    unknown = [c for c in columns if c not in FACET_COLUMNS]
+    if unknown:
+        return jsonify({"error": f"Not a filter column: {', '.join(unknown)}"}), 400
+    if request.args.get('epoch') != stock_model.epoch:
+        known = {}
+    try:
+        version, df, versions, counts = stock_model.facet_counts(columns)
+        facets = {}
+        for column in columns:
+            # a facet only depends on its own column and on the columns filtering it
+            facet_version = max(versions.get(c, version) for c in [column, *filters])
+            if known.get(column) == facet_version:
+                continue
+            facets[column] = {"version": facet_version,
+                              "values": facet_values(version, df, column, counts[column], filters)}
+        return jsonify({"epoch": stock_model.epoch, "version": version, "facets": facets})
+    except Exception as e:
+        print(f"Error in stock_facets: {e}")
+        traceback.print_exc()
+        return jsonify({}), 500
+
+@app.route('/stock-changes', methods=['GET'])
+def stock_changes():
+    """
+    Incremental feed: ?since=<version>&epoch=<epoch> from the previous response.
+    Returns {"epoch", "version", "changes": [{"seq", "op", "index", "row"}, ...]} with op one of
+    insert/update/delete ('row' is null for delete). When the changes can't be served
+    (first call, server restarted, client too far behind, workbook edited outside the app)
+    returns {"epoch", "version", "full": true, "rows": [...]} instead.
+    For other clients of the API: View Stock doesn't apply deltas from here, it refetches the
+    server-side page it shows (/get-stock-data?offset&limit...), which is already as small.
+    """
+    try:
+        version, df = stock_model.state()
+        etag = stock_model.etag(version)
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+        try:
+            since = int(request.args.get('since', ''))
+        except ValueError:
+            since = None
+        changes = None
+        if since is not None and request.args.get('epoch') == stock_model.epoch:
+            changes = stock_model.changes_since(since)
+        if changes is None:
+            payload = {"epoch": stock_model.epoch, "version": version, "full": True,
+                       "rows": display_frame(df).reset_index().to_dict('records')}
+        else:
+            # the log may already hold changes newer than the frame we read above
+            changes = [c for c in changes if c['seq'] <= version]
+            payload = {"epoch": stock_model.epoch, "version": version, "changes": changes}
+        return json_with_etag(app.json.dumps(payload), etag)
+    except FileNotFoundError:
+        print("Excel file not found in stock_changes.")
+        return jsonify({}), 404
+    except Exception as e:
+        print(f"Error in stock_changes: {e}")
+        traceback.print_exc()
+        return jsonify({}), 500
+
+@app.route('/stock-events', methods=['GET'])
+def stock_events_stream():
+    """
+    Server-Sent Events stream of stock changes, pushed as soon as Goods In / Goods Out commit.
+    Events: 'changes' ({"epoch", "since", "version", "changes": [{"seq", "op", "index"}, ...]}:
+    which lines changed, without their rows - fetch them from /stock-changes or the paged
+    endpoints) and 'resync' (the stock was reloaded, or the client fell behind). Comment
+    lines keep the connection alive every SSE_HEARTBEAT_SECONDS.
+    The View Stock page treats both as a cue to refetch the page it shows.
+    The dev server holds a thread per open stream, so the number of streams is capped
+    (503 -> the page keeps polling) and each stream ends after SSE_MAX_STREAM_SECONDS;
+    EventSource reconnects by itself and the page refetches its page on reconnect.
+    """
+    q = stock_events.subscribe()
+    if q is None:
+        return jsonify({"error": "Too many live stock connections"}), 503
+
+    def stream():
+        deadline = time.monotonic() + SSE_MAX_STREAM_SECONDS
+        try:
+            yield "retry: 3000\n\n"
+            while time.monotonic() < deadline:
+                try:
+                    event, data = q.get(timeout=SSE_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    # also notices edits made to the workbook in Excel while nobody is polling
+                    try:
+                        stock_model.state()
+                    except Exception as e:
+                        print(f"Error checking stock workbook in stock_events: {e}")
+                    yield ": heartbeat\n\n"
+                    continue
+                yield sse_message(event, data)
+        finally:
+            stock_events.unsubscribe(q)
+
+    resp = app.response_class(stream(), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
+
+@app.route('/stock/by-qr/<qr_id>', methods=['GET'])
+def stock_by_qr(qr_id):
+    """
+    Exact QR ID lookup for scanned labels: returns the stock row (with 'index' and 'row_version') or 404.
+    Served from the model's QR ID hash index, so it doesn't scan the stock.
+    """
+    try:
+        version, df, hits, versions = stock_model.find_qr(qr_id.strip())
+        etag = stock_model.etag(version)
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+        if not hits:
+            return jsonify({"error": "QR ID not found"}), 404
+        return json_with_etag(app.json.dumps(dict(stock_record(df, hits[0]), row_version=versions[hits[0]])), etag)
+    except FileNotFoundError:
+        print("Excel file not found in stock_by_qr.")
+        return jsonify({"error": "Excel file not found"}), 404
+    except Exception as e:
+        print(f"Error in stock_by_qr: {e}")
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/export-stock', methods=['POST'])
+def export_stock():
+    """Regenerate the stock workbook (excel_file) from the current stock right now."""
+    try:
+        stock_model.snapshot()
+        stock_model.flush(force=True)
+        return jsonify({"success": True})
+    except Exception as e:
+        print(f"Error in export_stock: {e}")
+        traceback.print_exc()
+        return jsonify({"success": False, "error": str(e)}), 500
+
 @app.route('/search-stock', methods=['GET'])
 def search_stock():
     """
     Search by Article Code, PRODUCTS (description), or QR ID.
     If query is empty, return the full stock.
     We reset_index() so that the returned rows include the original dataframe index as 'index' so front-end can identify rows.
+    The ETag is the stock version (the query is part of the URL), so repeated searches get a 304.
+    Matching is a plain case-insensitive substring test served from the model's trigram index.
+    Accepts the same offset/limit/sort/filters as /get-stock-data and then returns one page.
+    Each row also carries 'row_version' (StockModel.row_token: server epoch and stock version
+    of its last change), which /goods-out takes back to detect lines changed since they were shown.
+    Unpaged results can be streamed with ?stream=json|ndjson like /get-stock-data.
     """
     query = request.args.get('q', '').strip().lower()
     try:
-        df = pd.read_excel(excel_file, engine='openpyxl')
-        df = df.fillna('')
-        if 'QR ID' not in df.columns:
-            df['QR ID'] = ''
-        if query:
-            mask = (
-                df['Article Code'].astype(str).str.lower().str.contains(query) |
-                df['PRODUCTS'].astype(str).str.lower().str.contains(query) |
-                df['QR ID'].astype(str).str.lower().str.contains(query)
-            )
-            results = df[mask]
-        else:
-            results = df  # return all when empty
-        results = results.reset_index()  # keep original index in "index" column
-        # convert NaNs
-        results = results.fillna('')
-        return jsonify(results.to_dict('records'))
+        params = parse_stock_query(request.args)
+        stream = parse_stream_mode(request.args)
+    except ValueError as e:
+        return jsonify({"error": f"Bad query: {e}"}), 400
+    try:
+        version, df = stock_model.state()
+        etag = stock_model.etag(version)
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+        # return all when empty
+        version, full_df, hits, versions = stock_model.search(query)
+        etag = stock_model.etag(version)
+        if params is None and stream:
+            return stream_json(stream_rows(full_df, hits, versions, stream), etag, stream)
+        results = full_df.loc[hits].assign(row_version=[versions[i] for i in hits])
+        if params is not None:
+            return json_with_etag(dumps_json(query_stock(version, full_df, results, params)), etag)
+        results = display_frame(results).reset_index()  # keep original index in "index" column
+        return json_with_etag(dumps_json(results.to_dict('records')), etag)
     except Exception as e:
         print(f"Error in search_stock: {e}")
         traceback.print_exc()
         return jsonify([]), 500
 
+@app.route('/print-jobs', methods=['GET'])
+def print_jobs():
+    """Label print jobs, newest first: {"waiting": <jobs not yet started>, "jobs": [...]}."""
+    return jsonify({"waiting": print_queue.queue.qsize(), "jobs": print_queue.recent()})
+
+@app.route('/print-jobs/<int:job_id>', methods=['GET'])
+def print_job(job_id):
+    job = print_queue.status(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown print job"}), 404
+    return jsonify(job)
+
+@app.route('/print-labels', methods=['POST'])
+def print_labels():
+    """
+    (Re)print the labels of existing stock lines as one print job / spool document.
+    Payload: {"grn": "<GRN>"} for every line of a GRN, or {"rows": [index, ...]};
+    optional "copies" per line (default 1). Lines without a QR ID are skipped.
+    Returns the queued job, 503 when the print queue is full.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        copies = int(data.get('copies', 1))
+    except (TypeError, ValueError):
+        return jsonify({"error": "copies must be a number"}), 400
+    if copies <= 0:
+        return jsonify({"error": "copies must be positive"}), 400
+    try:
+        version, df = stock_model.state()
+        if data.get('grn'):
+            lines = df[column_text(version, df, 'GRN') == str(data['grn'])]
+        else:
+            lines = df.loc[df.index.intersection(data.get('rows', []))]
+        lines = lines[text_series(lines['QR ID']).str.strip() != '']
+        if lines.empty:
+            return jsonify({"error": "No labelled stock lines found"}), 404
+        job = print_queue.submit([{'article': row['Article Code'], 'item': row['PRODUCTS'], 'batch': row['Supplier Batch'],
+                                   'grn': row['GRN'], 'qr_id': str(row['QR ID']).strip(), 'copies': copies}
+                                  for row in display_frame(lines).to_dict('records')])
+        if job is None:
+            return jsonify({"error": "Print queue is full, try again shortly"}), 503
+        print(f"Queued print job {job['id']}: {len(lines)} line(s) x {copies} label(s)")
+        return jsonify(job)
+    except Exception as e:
+        print(f"Error in print_labels: {e}")
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+def plan_goods_out(df, selected_ids, adjust_map, expected_versions=None, row_version=None):
+    """
+    Work out a whole Goods Out in one pass over the selected lines.
+    Returns (new frame, changes for commit(), one result per requested id):
+    {"index", "status": "deleted" | "updated" | "skipped" | "conflict", "quantity" (after the pick), "error"}.
+    Lines are skipped (and the rest still applied) for unknown or repeated ids and
+    adjust amounts that aren't numbers.
+    expected_versions ({"index": row_version} as shown to the picker) makes the pick
+    conditional: a line whose row_version(index) differs has changed since and is not
+    touched; its result is a "conflict" carrying the current quantity and row_version.
+    """
+    req = pd.DataFrame({'sid': list(selected_ids)})
+    req['index'] = pd.to_numeric(req['sid'], errors='coerce')
+    req['adjust'] = [adjust_map.get(str(sid), '') for sid in req['sid']]  # front-end sends keys as strings
+    req['blank'] = req['adjust'].map(lambda v: v is None or str(v).strip() == '')
+    req['amount'] = pd.to_numeric(req['adjust'].where(~req['blank']), errors='coerce')
+    req['error'] = None
+    req.loc[req['index'].isna() | (req['index'] != req['index'].round()), 'error'] = 'invalid line id'
+    ok = req['error'].isna()
+    req.loc[ok & ~req['index'].isin(df.index), 'error'] = 'line not found (may have been removed already)'
+    ok = req['error'].isna()
+    req.loc[ok & req['index'].duplicated(), 'error'] = 'line listed more than once'
+    ok = req['error'].isna()
+    req.loc[ok & ~req['blank'] & req['amount'].isna(), 'error'] = 'adjust amount is not a number'
+    ok = req['error'].isna()
+    expected = pd.Series([(expected_versions or {}).get(str(sid)) for sid in req['sid']], index=req.index, dtype=object)
+    check = ok & expected.notna()
+    current_versions = req.loc[check, 'index'].astype('int64').map(row_version).astype(object)
+    stale = current_versions.index[current_versions.to_numpy() != expected[check].astype(str).to_numpy()]
+    req.loc[stale, 'error'] = 'line changed since it was loaded'
+    ok = req['error'].isna()
+
+    picks = req[ok]
+    ids = picks['index'].astype('int64').to_numpy()
+    current = df.loc[ids, 'Available Quantity'].fillna(0.0).to_numpy(dtype='float64')
+    # no adjust amount -> remove the full line
+    new_qty = current - picks['amount'].fillna(float('inf')).to_numpy()
+    delete = new_qty <= 0
+
+    df = df.drop(index=ids[delete])  # the one copy of the frame
+    if (~delete).any():
+        df.loc[ids[~delete], 'Available Quantity'] = new_qty[~delete]
+        df.loc[ids[~delete], 'Date Modified'] = pd.Timestamp.now().floor('s')
+
+    changes = [('delete' if d else 'update', int(i)) for i, d in zip(ids, delete)]
+    done = {pos: {'index': int(i), 'status': 'deleted' if d else 'updated', 'quantity': 0 if d else float(q), 'error': None}
+            for pos, i, d, q in zip(picks.index, ids, delete, new_qty)}
+    stale_ids = req.loc[stale, 'index'].astype('int64').to_numpy()
+    stale_qty = display_frame(df.loc[stale_ids, ['Available Quantity']])['Available Quantity'].tolist()
+    for pos, row_id, qty in zip(stale, stale_ids, stale_qty):
+        version = current_versions[pos]
+        done[pos] = {'index': int(row_id), 'status': 'conflict', 'error': req.at[pos, 'error'], 'quantity': qty,
+                     'row_version': None if pd.isna(version) else version}
+    results = [done.get(pos) or {'index': sid, 'status': 'skipped', 'quantity': None, 'error': e}
+               for pos, sid, e in zip(req.index, req['sid'], req['error'])]
+    return df, changes, results
+
 @app.route('/goods-out', methods=['POST'])
 def goods_out():
     """
     Payload:
     {
       "rows": [index1, index2, ...],
-      "adjust": {"index1": amount1, "index2": amount2, ...}
+      "adjust": {"index1": amount1, "index2": amount2, ...},
+      "versions": {"index1": row_version1, ...}   (optional, from /search-stock)
     }
+    The indexes are the stock lines' permanent ids (LINE_ID_COLUMN).
+    A line whose row_version no longer matches is left alone and reported as a "conflict"
+    with its current quantity and row_version, for the picker to re-confirm.
     For each selected index:
       - If an adjust amount is provided (numeric):
           subtract amount from Available Quantity. If result <= 0 -> drop the row.
       - If no adjust amount provided: drop the row.
+    The whole batch is applied at once (see plan_goods_out); the response lists what
+    happened to each line: {"success": true, "results": [...]}.
     """
     try:
         payload = request.get_json(force=True)
         selected_ids = payload.get('rows', [])
         adjust_map = payload.get('adjust', {}) or {}
+        expected_versions = payload.get('versions', {}) or {}
         if not selected_ids:
             return jsonify({"success": False, "error": "No rows provided"}), 400
 
-        # Read df
-        df = pd.read_excel(excel_file, engine='openpyxl')
-        df = df.fillna('')
-        # ensure numeric column exists
-        if 'Available Quantity' not in df.columns:
-            df['Available Quantity'] = 0
-
-        # operate on a copy index->int mapping
-        for sid in selected_ids:
-            try:
-                orig_index = int(sid)
-            except:
-                print("Invalid index in goods_out payload:", sid)
-                continue
-            # find row by original index
-            if orig_index not in df.index:
-                print("Index not in current df (may have been removed already):", orig_index)
-                continue
-            row_qty_raw = df.at[orig_index, 'Available Quantity']
-            try:
-                current_qty = float(row_qty_raw) if row_qty_raw not in (None, '') else 0.0
-            except Exception:
-                try:
-                    current_qty = float(str(row_qty_raw).replace(',', '')) if row_qty_raw else 0.0
-                except:
-                    current_qty = 0.0
-
-            # read adjust amount for this index if present
-            adj_val = adjust_map.get(str(orig_index), '')  # front-end sends keys as strings
-            if adj_val is None or str(adj_val).strip() == '':
-                # no adjust provided -> remove full row
-                df = df.drop(index=orig_index, errors='ignore')
-                print(f"Dropped full row {orig_index}")
-            else:
-                try:
-                    adj_num = float(adj_val)
-                except Exception:
-                    # invalid adjust -> skip
-                    print(f"Invalid adjust value for index {orig_index}: {adj_val} - skipping")
-                    continue
-                new_qty = current_qty - adj_num
-                if new_qty <= 0:
-                    df = df.drop(index=orig_index, errors='ignore')
-                    print(f"Adjusted out entire row {orig_index} (new_qty {new_qty} <= 0)")
-                else:
-                    df.at[orig_index, 'Available Quantity'] = new_qty
-                    # update Date Modified to now
-                    df.at[orig_index, 'Date Modified'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    print(f"Reduced index {orig_index} from {current_qty} by {adj_num} -> {new_qty}")
+        def pick(df):
+            # ensure numeric column exists
+            if 'Available Quantity' not in df.columns:
+                df = df.assign(**{'Available Quantity': 0.0})
+            # lines changed earlier in this writer batch have no committed version yet: always a conflict
+            df, changes, results = plan_goods_out(
+                df, selected_ids, adjust_map, expected_versions,
+                lambda i: None if i in stock_writer.touched else stock_model.row_token(i))
+            for res in results:
+                if res['status'] in ('skipped', 'conflict'):
+                    print(f"Goods out {res['status']} {res['index']}: {res['error']}")
+            print(f"Goods out: {sum(op == 'delete' for op, _ in changes)} line(s) removed, "
+                  f"{sum(op == 'update' for op, _ in changes)} reduced")
+            # reduced lines get the row_version their new quantity was committed under
+            return df, changes, lambda tokens: [dict(res, row_version=tokens[res['index']]) if res['status'] == 'updated'
+                                                else res for res in results]
 
-        # after changes, write back. Reset index will happen implicitly by to_excel
-        df.to_excel(excel_file, index=False, engine='openpyxl')
-        return jsonify({"success": True})
+        # Row ids (the index) stay stable across commits
+        results = stock_writer.submit(pick)
+        return jsonify({"success": True, "results": results})
     except Exception as e:
         print("Error in /goods-out:", e)
         traceback.print_exc()
@@ -260,6 +2369,8 @@ def desktop_index():
     Original 'Goods In' POST flow preserved, with changes:
     - generated QR ID is written into 'QR ID' column in Excel (column L as requested)
     - added print_quantity field to control number of labels printed, allowing 0 to disable printing
+    - labels go to print_queue after the stock is committed; the response doesn't wait for the printer
+    - the change is applied by stock_writer, so concurrent receipts / picks can't overwrite each other
     """
     if request.method == 'POST':
         po = request.form.get('po-number')
@@ -270,47 +2381,31 @@ def desktop_index():
         item = request.form.get('item')
         quantity = request.form.get('quantity')
         print_quantity = request.form.get('print-quantity', '1')  # Default to 1 if not provided
-        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        try:
-            df = pd.read_excel(excel_file, engine='openpyxl')
-            df = df.fillna('')
-            if 'QR ID' not in df.columns:
-                # Add QR ID as last column if missing
-                df['QR ID'] = ''
-            mask = (
-                (df['P/O'].astype(str) == str(po)) &
-                (df['GRN'].astype(str) == str(grn)) &
-                (df['Article Code'].astype(str) == str(article_code)) &
-                (df['Location'].astype(str) == str(location)) &
-                (df['PRODUCTS'].astype(str) == str(item))
-            )
-            matching_rows = df.loc[mask]
-            if not matching_rows.empty:
+        current_time = pd.Timestamp.now().floor('s')
+        # taken here, not on the stock writer (where an empty pool would hold up every receipt and pick,
+        # and a rerun batch take another); unused when the line already has a QR ID
+        new_qr_id = generate_qr_code_id() if article_code and item and supplier_batch else None
+        def receive(df):
+            # existing line with the same P/O, GRN, Article Code, Location and PRODUCTS (see CONSOLIDATION_COLUMNS)
+            matches = stock_writer.find_line(df, (po, grn, article_code, location, item))
+            df = df.copy()
+            changes = []  # (op, index) for the /stock-changes feed
+            label_qr_id = None  # set when a new QR ID was attached: its labels are queued once the stock is committed
+            if matches:
+                row_id = matches[0]
                 try:
                     new_quantity = float(quantity)
-                    existing_quantity = (
-                        float(matching_rows.iloc[0]['Available Quantity'])
-                        if pd.notna(matching_rows.iloc[0]['Available Quantity']) and matching_rows.iloc[0]['Available Quantity'] != ''
-                        else 0.0
-                    )
-                    updated_quantity = existing_quantity + new_quantity
-                    df.loc[matching_rows.index[0], 'Available Quantity'] = updated_quantity
-                    df.loc[matching_rows.index[0], 'Date Modified'] = current_time
-                    df.loc[matching_rows.index[0], 'Supplier Batch'] = supplier_batch
+                    existing_quantity = df.at[row_id, 'Available Quantity']  # numeric, NaN when empty
+                    df.loc[row_id, 'Available Quantity'] = (0.0 if pd.isna(existing_quantity) else existing_quantity) + new_quantity
+                    df.loc[row_id, 'Date Modified'] = current_time
+                    df.loc[row_id, 'Supplier Batch'] = supplier_batch
                     # If supplier generated a QR ID earlier for this, leave it; otherwise attach one now if needed
-                    if not df.loc[matching_rows.index[0], 'QR ID']:
-                        if article_code and item and supplier_batch:
-                            qr_id = generate_qr_code_id()
-                            df.loc[matching_rows.index[0], 'QR ID'] = qr_id
-                            try:
-                                print_qty = int(print_quantity) if print_quantity.strip() else 1
-                                if print_qty > 0:  # Only print if quantity is positive
-                                    for _ in range(print_qty):
-                                        print_godex_label(article_code, item, supplier_batch, grn, qr_id)
-                            except ValueError:
-                                print(f"Invalid print quantity '{print_quantity}', printing 1 label")
-                                print_godex_label(article_code, item, supplier_batch, grn, qr_id)
-                    print(f"Consolidated stock for matching row: {matching_rows.index[0]}")
+                    if not filter_text(df.at[row_id, 'QR ID']):
+                        if new_qr_id:
+                            df.loc[row_id, 'QR ID'] = new_qr_id
+                            label_qr_id = new_qr_id
+                    changes.append(('update', row_id))
+                    print(f"Consolidated stock for matching row: {row_id}")
                 except ValueError:
                     print(f"Warning: Could not convert quantity '{quantity}' to number for consolidation.")
             else:
@@ -329,23 +2424,28 @@ def desktop_index():
                     'QR ID': ''
                 }
                 # Generate QR ID if all required fields present
-                if article_code and item and supplier_batch:
-                    qr_id = generate_qr_code_id()
-                    new_row['QR ID'] = qr_id
-                    try:
-                        print_qty = int(print_quantity) if print_quantity.strip() else 1
-                        if print_qty > 0:  # Only print if quantity is positive
-                            for _ in range(print_qty):
-                                print_godex_label(article_code, item, supplier_batch, grn, qr_id)
-                    except ValueError:
-                        print(f"Invalid print quantity '{print_quantity}', printing 1 label")
-                        print_godex_label(article_code, item, supplier_batch, grn, qr_id)
-                df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
+                if new_qr_id:
+                    new_row['QR ID'] = new_qr_id
+                    label_qr_id = new_qr_id
+                new_index = stock_model.allocate_row_id()
+                df = append_stock_row(df, new_index, new_row)
+                changes.append(('insert', new_index))
                 print("Added new row:", new_row)
             # Ensure QR ID column exists (safety)
             if 'QR ID' not in df.columns:
                 df['QR ID'] = ''
-            df.to_excel(excel_file, index=False, engine='openpyxl')
+            return df, changes, label_qr_id
+
+        try:
+            label_qr_id = stock_writer.submit(receive)
+            copies = label_copies(print_quantity) if label_qr_id else 0
+            if copies > 0:  # Only print if quantity is positive
+                job = print_queue.submit([{'article': article_code, 'item': item, 'batch': supplier_batch,
+                                           'grn': grn, 'qr_id': label_qr_id, 'copies': copies}])
+                if job is None:
+                    print(f"Print queue full: labels for QR ID {label_qr_id} were not queued (listed as failed in /print-jobs)")
+                else:
+                    print(f"Queued print job {job['id']}: {copies} label(s) for QR ID {label_qr_id}")
             # redirect back to main route (keeps same behaviour)
             return redirect('/MPH-Stock/')
         except FileNotFoundError:
@@ -528,6 +2628,24 @@ z-index: 3;
 .filter-indicator.active {
     display: block;
 }
+.stock-table thead th[data-column] {
+    cursor: pointer;
+}
+.stock-table thead th.sort-asc:before {
+    content: "▲ ";
+    font-size: 9px;
+}
+.stock-table thead th.sort-desc:before {
+    content: "▼ ";
+    font-size: 9px;
+}
+.stock-pager {
+    display: flex;
+    align-items: center;
+    justify-content: flex-end;
+    gap: 10px;
+    margin-top: 8px;
+}
 
 /* responsive */
 @media (max-width:768px){
@@ -663,6 +2781,11 @@ th,td{padding:8px 10px;font-size:14px}
 <tbody></tbody>
 </table>
 </div>
+<div class="stock-pager">
+<button id="stock-prev" onclick="changeStockPage(-1)">&laquo; Prev</button>
+<span id="stock-pager-info"></span>
+<button id="stock-next" onclick="changeStockPage(1)">Next &raquo;</button>
+</div>
 </div>
 
 <!-- Filter dropdowns positioned outside the table -->
@@ -762,7 +2885,9 @@ th,td{padding:8px 10px;font-size:14px}
 /*
 Client-side logic:
 - showSection: simple navigation
-- loadStock: loads all stock for View Stock (hides 'QR ID' column)
+- loadStock: refetches the View Stock page shown (server-side paging, sorting and filters;
+  304 while nothing changed) when pushed a change, on reconnect or by the 10 s poll;
+  hides 'QR ID' column
 - searchGoodsOut: searches (by code, description, or QR) and displays rows.
 - persist selections and per-row adjust amounts across searches using JS maps.
 - submitGoodsOut: sends adjustments + selected rows to /goods-out.
@@ -770,15 +2895,26 @@ Client-side logic:
 */
 
 let stockInterval = null;
-let allStockData = []; // Store all stock data for filtering
-let filteredStockData = []; // Store currently filtered data
+let stockEvents = null; // EventSource for /stock-events while View Stock is open
 let activeFilters = {}; // Store active filters {columnName: [selectedValues]}
 let currentDropdownColumn = null; // Track which column's dropdown is open
+const facetCache = {}; // column -> {filters, epoch, version, values} from /stock-facets
+let stockRefreshTimer = null;
+// the table itself shows one server-side page (/get-stock-data?offset&limit&sort&filters)
+const STOCK_PAGE_SIZE = 200;
+let stockOffset = 0;
+let stockTotal = 0;
+let stockSort = []; // e.g. ['Location', '-Available Quantity']
+let stockPageUrl = null; // URL and ETag of the page currently shown
+let stockPageEtag = null;
+let stockPageRequest = 0; // drops responses of superseded page requests
 
 // Keep track of selected rows (original dataframe indexes) as strings
 const selectedRows = new Set();
 // Keep track of adjust values by index (strings)
 const adjustMap = {}; // e.g. {"123": "5"}
+// row_version of each line as last shown, sent with Goods Out so changed lines are caught
+const rowVersions = {};
 
 function escapeHtml(unsafe) {
     return unsafe.replace(/&/g, "&amp;").replace(/</g, "&lt;").replace(/>/g, "&gt;").replace(/"/g, "&quot;").replace(/'/g, "&#039;");
@@ -789,14 +2925,45 @@ document.querySelectorAll('.main-menu,.content-section').forEach(el=>el.style.di
 const sec = document.getElementById(sectionId);
 if(!sec) return;
 sec.style.display = 'block';
-// if viewing stock, load stock and refresh periodically
+// if viewing stock, load stock and keep it live (pushed over /stock-events, polling as fallback)
 if(sectionId === 'view-stock-section'){
 loadStock();
-if(stockInterval) clearInterval(stockInterval);
-stockInterval = setInterval(loadStock, 10000);
+startStockPolling();
+startStockEvents();
 } else {
+stopStockPolling();
+if(stockEvents) { stockEvents.close(); stockEvents = null; }
+}
+}
+
+function startStockPolling(){
+if(!stockInterval) stockInterval = setInterval(loadStock, 10000);
+}
+
+function stopStockPolling(){
 if(stockInterval) { clearInterval(stockInterval); stockInterval = null; }
 }
+
+// live updates: poll only while the event stream is not connected
+function startStockEvents(){
+if(!window.EventSource || stockEvents) return;
+stockEvents = new EventSource('/stock-events');
+stockEvents.onopen = () => {
+stopStockPolling();
+loadStock(); // catch up on anything missed while disconnected
+};
+stockEvents.onerror = () => {
+startStockPolling();
+if(stockEvents && stockEvents.readyState === EventSource.CLOSED) stockEvents = null;
+};
+stockEvents.addEventListener('changes', scheduleStockRefresh);
+stockEvents.addEventListener('resync', scheduleStockRefresh);
+}
+
+// a burst of pushed changes only refetches once
+function scheduleStockRefresh(){
+if(stockRefreshTimer) return;
+stockRefreshTimer = setTimeout(() => { stockRefreshTimer = null; loadStock(); }, 250);
 }
 
 window.onload = () => {
@@ -837,56 +3004,131 @@ return isoDateStr;
 }
 }
 
-// load full stock for the View Stock page
-async function loadStock(){
+// refresh the View Stock page: the rows shown (304 while nothing changed) and the open filter dropdown
+function loadStock(){
+loadStockPage();
+const dropdown = currentDropdownColumn && document.getElementById(`dropdown-${currentDropdownColumn}`);
+if(dropdown && dropdown.classList.contains('show')) loadFacet(currentDropdownColumn);
+}
+
+// fetch and render the current page of the View Stock table
+async function loadStockPage(){
+const params = new URLSearchParams({offset: stockOffset, limit: STOCK_PAGE_SIZE});
+if(stockSort.length > 0) params.set('sort', stockSort.join(','));
+if(hasActiveFilters()) params.set('filters', JSON.stringify(activeFilters));
+const url = '/get-stock-data?' + params.toString();
+const request = ++stockPageRequest;
 try{
-const resp = await fetch('/get-stock-data');
+const headers = (url === stockPageUrl && stockPageEtag) ? {'If-None-Match': stockPageEtag} : {};
+const resp = await fetch(url, {headers: headers, cache: 'no-store'});
+if(request !== stockPageRequest || resp.status === 304) return;
+if(!resp.ok) throw new Error('HTTP ' + resp.status);
 const data = await resp.json();
-allStockData = data;
-filteredStockData = data;
-renderStockTable(data);
-generateFilterOptions();
+if(request !== stockPageRequest) return;
+stockTotal = data.total;
+if(stockOffset > 0 && stockOffset >= stockTotal){
+// the page emptied (rows went out or filters narrowed), go to the last one
+stockOffset = Math.max(0, Math.floor((stockTotal - 1) / STOCK_PAGE_SIZE) * STOCK_PAGE_SIZE);
+loadStockPage();
+return;
+}
+stockPageUrl = url;
+stockPageEtag = resp.headers.get('ETag');
+renderStockTable(data.rows);
+updateStockPager();
 }catch(err){
-console.error('Error loading stock:', err);
+console.error('Error loading stock page:', err);
+}
+}
+
+function updateStockPager(){
+const first = stockTotal === 0 ? 0 : stockOffset + 1;
+const last = Math.min(stockOffset + STOCK_PAGE_SIZE, stockTotal);
+document.getElementById('stock-pager-info').textContent = `${first}–${last} of ${stockTotal}`;
+document.getElementById('stock-prev').disabled = stockOffset === 0;
+document.getElementById('stock-next').disabled = last >= stockTotal;
+}
+
+function changeStockPage(step){
+const offset = stockOffset + step * STOCK_PAGE_SIZE;
+if(offset < 0 || offset >= stockTotal) return;
+stockOffset = offset;
+loadStockPage();
+document.getElementById('stock-table-container').scrollTop = 0;
 }
+
+// header click: sort by that column, click again to reverse
+function toggleStockSort(column){
+stockSort = [stockSort[0] === column ? '-' + column : column];
+document.querySelectorAll('#stock-table thead th').forEach(th => {
+th.classList.toggle('sort-asc', stockSort[0] === th.dataset.column);
+th.classList.toggle('sort-desc', stockSort[0] === '-' + th.dataset.column);
+});
+stockOffset = 0;
+loadStockPage();
+}
+
+// Fetch one column's dropdown values and counts (counts follow the other columns' filters);
+// only re-rendered when /stock-facets says the facet changed since the one we hold
+async function loadFacet(column) {
+    const other = {};
+    for (const c in activeFilters) {
+        if (c !== column && activeFilters[c] && activeFilters[c].length > 0) other[c] = activeFilters[c];
+    }
+    const filters = JSON.stringify(other);
+    const cached = facetCache[column];
+    const params = new URLSearchParams({columns: column, filters: filters});
+    if (cached && cached.filters === filters) {
+        params.set('epoch', cached.epoch);
+        params.set('known', JSON.stringify({[column]: cached.version}));
+    }
+    try {
+        const resp = await fetch('/stock-facets?' + params.toString(), {cache: 'no-store'});
+        if (!resp.ok) throw new Error('HTTP ' + resp.status);
+        const data = await resp.json();
+        const facet = data.facets[column];
+        if (!facet) return; // unchanged
+        facetCache[column] = {filters: filters, epoch: data.epoch, version: facet.version, values: facet.values};
+        renderFilterOptions(column);
+    } catch (err) {
+        console.error('Error loading filter values:', err);
+    }
 }
 
-// Generate filter options for each column
-function generateFilterOptions() {
-    const columns = ['Article Code', 'PRODUCTS', 'P/O', 'GRN', 'Supplier Batch', 'PACK TYPE', 'Location', 'Allocated Quantity'];
+// Build a column's dropdown options from facetCache
+function renderFilterOptions(column) {
+    const optionsList = document.getElementById(`options-${column}`);
+    if (!optionsList) return; // Skip if element doesn't exist
+    const values = facetCache[column] ? [...facetCache[column].values] : [];
+    // keep selected values listed (with 0) so they can still be unticked
+    (activeFilters[column] || []).forEach(value => {
+        if (!values.some(item => item[0] === value)) values.push([value, 0]);
+    });
     
-    columns.forEach(column => {
-        const values = [...new Set(allStockData.map(row => String(row[column] ?? '')))];
-        values.sort();
-        
-        const optionsList = document.getElementById(`options-${column}`);
-        if (!optionsList) return; // Skip if element doesn't exist
+    optionsList.innerHTML = '';
+    
+    // Add individual options
+    values.forEach(([value, count]) => {
+        if (value === '') return; // Skip empty values
+        const li = document.createElement('li');
+        const chkId = `chk-${column.replace(/[^a-zA-Z0-9]/g, '-')}-${value.replace(/[^a-zA-Z0-9]/g, '-')}`;
+        li.innerHTML = `<input type="checkbox" id="${chkId}" data-value="${escapeHtml(value)}">
+                        <label for="${chkId}">${escapeHtml(value)} (${count})</label>`;
+        li.dataset.value = value;
         
-        optionsList.innerHTML = '';
+        const checkbox = li.querySelector('input');
         
-        // Add individual options
-        values.forEach(value => {
-            if (value === '') return; // Skip empty values
-            const li = document.createElement('li');
-            const chkId = `chk-${column.replace(/[^a-zA-Z0-9]/g, '-')}-${value.replace(/[^a-zA-Z0-9]/g, '-')}`;
-            li.innerHTML = `<input type="checkbox" id="${chkId}" data-value="${escapeHtml(value)}">
-                            <label for="${chkId}">${escapeHtml(value)}</label>`;
-            li.dataset.value = value;
-            
-            const checkbox = li.querySelector('input');
-            
-            // Check if this value is selected in active filters
-            if (activeFilters[column] && activeFilters[column].includes(value)) {
-                checkbox.checked = true;
-            }
-            
-            checkbox.addEventListener('change', () => toggleFilterSelection(column, value, checkbox));
-            optionsList.appendChild(li);
-        });
+        // Check if this value is selected in active filters
+        if (activeFilters[column] && activeFilters[column].includes(value)) {
+            checkbox.checked = true;
+        }
         
-        // Update filter indicator
-        updateFilterIndicator(column);
+        checkbox.addEventListener('change', () => toggleFilterSelection(column, value, checkbox));
+        optionsList.appendChild(li);
     });
+    
+    // Update filter indicator
+    updateFilterIndicator(column);
 }
 
 // Toggle filter dropdown
@@ -907,9 +3149,10 @@ function toggleFilterDropdown(column, event) {
     // Toggle current dropdown
     dropdown.classList.toggle('show');
     
-    // Focus search input
+    // Load its values and focus search input
     const searchInput = dropdown.querySelector('input');
     if (dropdown.classList.contains('show')) {
+        loadFacet(column);
         searchInput.focus();
     }
 }
@@ -958,7 +3201,7 @@ function toggleFilterSelection(column, value, checkbox) {
 // Clear filters for a specific column
 function clearColumnFilters(column) {
     activeFilters[column] = [];
-    generateFilterOptions(); // Regenerate to uncheck all checkboxes
+    renderFilterOptions(column); // Regenerate to uncheck all checkboxes
     applyFilters();
     
     // Hide the dropdown after clearing
@@ -981,34 +3224,14 @@ function updateFilterIndicator(column) {
     }
 }
 
-// Apply all active filters with OR logic
+function hasActiveFilters() {
+    return Object.values(activeFilters).some(filters => filters && filters.length > 0);
+}
+
+// Apply all active filters: OR within a column, AND across columns (done server-side)
 function applyFilters() {
-    // If no filters are active, show all data
-    const hasActiveFilters = Object.values(activeFilters).some(filters => filters && filters.length > 0);
-    
-    if (!hasActiveFilters) {
-        filteredStockData = [...allStockData];
-        renderStockTable(filteredStockData);
-        return;
-    }
-    
-    // Apply AND logic between columns: show rows that match ALL active column filters
-    let filtered = allStockData.filter(row => {
-        // For each column with active filters, check if the row matches at least one value
-        for (const column in activeFilters) {
-            if (activeFilters[column] && activeFilters[column].length > 0) {
-                const rowValue = String(row[column] ?? '');
-                // If row doesn't match any of the selected values in this column, exclude it
-                if (!activeFilters[column].includes(rowValue)) {
-                    return false;
-                }
-            }
-        }
-        return true; // Row matches all active filters
-    });
-    
-    filteredStockData = filtered;
-    renderStockTable(filtered);
+    stockOffset = 0;
+    loadStockPage();
 }
 
 // Filter options based on search input
@@ -1019,20 +3242,15 @@ function filterOptions(column) {
     const options = optionsContainer.getElementsByTagName('li');
     
     for (let i = 0; i < options.length; i++) {
-        const txtValue = options[i].textContent || options[i].innerText;
+        const txtValue = options[i].dataset.value || '';
         options[i].style.display = txtValue.toUpperCase().indexOf(filter) > -1 ? "" : "none";
     }
 }
 
-// Render stock table with given data
-function renderStockTable(data) {
-    const tbody = document.querySelector('#stock-table tbody');
-    tbody.innerHTML = '';
-    
-    data.forEach(row => {
-        const tr = document.createElement('tr');
-        // hide QR ID intentionally (not shown)
-        tr.innerHTML = `
+// Cells of one View Stock row
+function stockRowCells(row) {
+    // hide QR ID intentionally (not shown)
+    return `
         <td>${row['Article Code'] ?? ''}</td>
         <td>${row['PRODUCTS'] ?? ''}</td>
         <td>${row['P/O'] ?? ''}</td>
@@ -1045,8 +3263,20 @@ function renderStockTable(data) {
         <td>${formatDateDisplay(row['Date Counted'] ?? '')}</td>
         <td>${row['Allocated Quantity'] ?? ''}</td>
         `;
-        tbody.appendChild(tr);
-    });
+}
+
+function stockRowElement(row) {
+    const tr = document.createElement('tr');
+    tr.dataset.index = row['index'];
+    tr.innerHTML = stockRowCells(row);
+    return tr;
+}
+
+// Render stock table with given data
+function renderStockTable(data) {
+    const tbody = document.querySelector('#stock-table tbody');
+    tbody.innerHTML = '';
+    data.forEach(row => tbody.appendChild(stockRowElement(row)));
 }
 
 // GOODS OUT: keep selections across searches
@@ -1061,6 +3291,7 @@ return;
 let html = '<table class="stock-table"><thead><tr><th style="width:40px"></th><th>Article Code</th><th>Item</th><th>Batch</th><th>Location</th><th>Qty</th><th>Adjust Out</th></tr></thead><tbody>';
 rows.forEach(row => {
 const idx = row['index'];
+if(row['row_version'] !== undefined) rowVersions[String(idx)] = row['row_version'];
 const checked = selectedRows.has(String(idx)) ? 'checked' : '';
 const adjVal = (adjustMap[String(idx)] !== undefined) ? adjustMap[String(idx)] : '';
 const qty = (row['Available Quantity'] === null || row['Available Quantity'] === undefined) ? '' : row['Available Quantity'];
@@ -1108,6 +3339,14 @@ const q = document.getElementById('goods-out-search').value.trim();
 const container = document.getElementById('goods-out-results');
 container.innerHTML = '<p>Searching...</p>';
 try{
+// a scanned 16-character label resolves through the exact QR ID lookup
+if(/^[A-Z0-9]{16}$/.test(q)){
+const qrResp = await fetch('/stock/by-qr/' + encodeURIComponent(q));
+if(qrResp.ok){
+renderGoodsOutTable([await qrResp.json()]);
+return;
+}
+}
 const resp = await fetch('/search-stock?q=' + encodeURIComponent(q));
 const data = await resp.json();
 // show results (but hide QR ID column; data will still have it)
@@ -1132,15 +3371,31 @@ for(const k of Object.keys(adjustMap)){
 // only include adjusts for rows that are selected
 if(selectedRows.has(String(k))) adjust[String(k)] = adjustMap[k];
 }
+const versions = {};
+rows.forEach(k => { if(rowVersions[k] !== undefined) versions[k] = rowVersions[k]; });
 try{
 const resp = await fetch('/goods-out', {
 method: 'POST',
 headers: {'Content-Type': 'application/json'},
-body: JSON.stringify({rows: rows, adjust: adjust})
+body: JSON.stringify({rows: rows, adjust: adjust, versions: versions})
 });
 const result = await resp.json();
-if(result.success){
-alert('Goods Out processed');
+const conflicts = (result.results || []).filter(res => res.status === 'conflict');
+if(result.success && conflicts.length > 0){
+// the rest went through; keep only the changed lines selected for the picker to re-confirm
+const conflictIds = new Set(conflicts.map(res => String(res.index)));
+for(const k of Array.from(selectedRows)) if(!conflictIds.has(k)) selectedRows.delete(k);
+for(const k in adjustMap) if(!conflictIds.has(k)) delete adjustMap[k];
+conflicts.forEach(res => { rowVersions[String(res.index)] = res.row_version; });
+alert(`${conflicts.length} line(s) changed since they were loaded and were not picked:\\n`
++ conflicts.map(res => `${res.index}: now ${res.quantity ?? 'unknown'} in stock`).join('\\n')
++ '\\nCheck the quantities and submit again.');
+searchGoodsOut();
+} else if(result.success){
+const skipped = (result.results || []).filter(res => res.status === 'skipped');
+alert('Goods Out processed' + (skipped.length
+? `\\n${skipped.length} line(s) skipped:\\n` + skipped.map(res => `${res.index}: ${res.error}`).join('\\n')
+: ''));
 // clear selections & adjustments
 selectedRows.clear();
 for(const k in adjustMap) delete adjustMap[k];
@@ -1168,6 +3423,11 @@ document.getElementById('stock-table-container').addEventListener('scroll', func
     }
 });
 
+// Sort the View Stock table by clicking a header (the filter buttons stop propagation)
+document.querySelectorAll('#stock-table thead th').forEach(th => {
+    th.addEventListener('click', () => toggleStockSort(th.dataset.column));
+});
+
 </script>
 </body>
 </html>
@@ -1175,8 +3435,22 @@ document.getElementById('stock-table-container').addEventListener('scroll', func
 
 # === Run server ===
 if __name__ == '__main__':
+    # one-shot maintenance: python Main.py --import-xlsx (workbook -> SQLite) / --export-xlsx (stock -> workbook)
+    # / --import-qr-codes (QR-Codes.txt -> QR-Codes.bin)
+    if '--import-xlsx' in sys.argv:
+        SqliteStockStore(sqlite_file, excel_file).import_workbook(excel_file, journal_file)
+        sys.exit(0)
+    if '--import-qr-codes' in sys.argv:
+        printed_qr_codes.rebuild()
+        sys.exit(0)
+    if '--export-xlsx' in sys.argv:
+        stock_model.snapshot()
+        stock_model.flush(force=True)
+        sys.exit(0)
     PORT = 1567
     terminate_process_on_port(PORT)
+    # exit cleanly on SIGTERM (e.g. from the next instance starting) so pending stock changes get saved
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     try:
         app.run(host='0.0.0.0', port=PORT, debug=True, threaded=True, use_reloader=False)
     except KeyboardInterrupt: